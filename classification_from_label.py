@@ -4,6 +4,87 @@ Infer acquisition classification by parsing the description label.
 '''
 
 import re
+import sys
+import time
+import functools
+import collections
+
+# Profiling: evaluation counts, hits and cumulative time of every rule and
+# pattern, collected while enabled. The rules are the is_* predicates and the
+# feature, measurement and intent checks.
+_profile = None
+
+
+class RuleProfile(object):
+    """Evaluation counts, hits and cumulative time per rule and per pattern."""
+
+    def __init__(self):
+        # (rule) and (rule, pattern) -> [evaluations, hits, seconds]
+        self.rules = collections.OrderedDict()
+        self.patterns = collections.OrderedDict()
+
+    def _record(self, stats, key, hit, seconds):
+        entry = stats.setdefault(key, [0, 0, 0.0])
+        entry[0] += 1
+        entry[1] += int(bool(hit))
+        entry[2] += seconds
+
+    def search_label(self, regexes, label, rule):
+        # Same short-circuit as regex_search_label, timing each pattern
+        rule_start = time.perf_counter()
+        matched = False
+        for regex in regexes:
+            start = time.perf_counter()
+            hit = regex.search(label)
+            self._record(self.patterns, (rule, regex.pattern), hit, time.perf_counter() - start)
+            if hit:
+                matched = True
+                break
+        self._record(self.rules, rule, matched, time.perf_counter() - rule_start)
+        return matched
+
+    def find_matches(self, label, terms, rule):
+        rule_start = time.perf_counter()
+        matches = []
+        for term in terms:
+            start = time.perf_counter()
+            hit = _compile_regex(term).findall(label)
+            self._record(self.patterns, (rule, term), hit, time.perf_counter() - start)
+            if hit:
+                matches.append(term)
+        self._record(self.rules, rule, matches, time.perf_counter() - rule_start)
+        return matches
+
+    def report(self, stream=None):
+        """Write the rules, then the patterns, by decreasing cumulative time."""
+        stream = stream or sys.stdout
+        row = '%-60s %10s %10s %12s %10s\n'
+        stream.write(row % ('rule', 'evals', 'hits', 'total ms', 'us/eval'))
+        for rule, (evals, hits, seconds) in self._by_time(self.rules):
+            stream.write(row % (rule, evals, hits, '%.3f' % (seconds * 1e3),
+                                '%.2f' % (seconds * 1e6 / evals)))
+        stream.write('\n')
+        stream.write(row % ('rule / pattern', 'evals', 'hits', 'total ms', 'us/eval'))
+        for (rule, pattern), (evals, hits, seconds) in self._by_time(self.patterns):
+            stream.write(row % ('%s / %s' % (rule, pattern), evals, hits,
+                                '%.3f' % (seconds * 1e3), '%.2f' % (seconds * 1e6 / evals)))
+
+    def _by_time(self, stats):
+        return sorted(stats.items(), key=lambda item: item[1][2], reverse=True)
+
+
+def enable_profiling():
+    """Start collecting rule statistics in a new RuleProfile and return it."""
+    global _profile
+    _profile = RuleProfile()
+    return _profile
+
+
+def disable_profiling():
+    """Stop collecting rule statistics, returning the RuleProfile collected."""
+    global _profile
+    profile, _profile = _profile, None
+    return profile
 
 
 def feature_check(label):
@@ -25,7 +106,7 @@ def feature_check(label):
                    'Gradient-Unwarped', 'Motion-Corrected', 'Physio-Corrected',
                    'Derived', 'In-Plane', 'Phase', 'Magnitude']
 
-    return _find_matches(label, feature_list)
+    return _find_matches(label, feature_list, 'feature_check')
 
 
 def measurement_check(label):
@@ -35,7 +116,7 @@ def measurement_check(label):
                         'Phoenix','B0', 'B1', 'T1', 'T2', 'T2*', 'PD', 'MT',
                         'Perfusion','Diffusion', 'Susceptibility', 'Fingerprinting']
 
-    return _find_matches(label, measurement_list)
+    return _find_matches(label, measurement_list, 'measurement_check')
 
 
 def intent_check(label):
@@ -44,12 +125,15 @@ def intent_check(label):
     intent_list = [ 'Localizer', 'Shim', 'Calibration', 'Fieldmap', 'Structural',
                     'Functional', 'Screenshot', 'Non-Image', 'Spectroscopy' ]
 
-    return _find_matches(label, intent_list)
+    return _find_matches(label, intent_list, 'intent_check')
 
 
-def _find_matches(label, list):
+def _find_matches(label, list, rule=None):
     """For a given list find those entries that match a given label."""
 
+    if _profile is not None:
+        return _profile.find_matches(label, list, rule)
+
     matches = []
 
     for l in list:
@@ -60,6 +144,7 @@ def _find_matches(label, list):
     return matches
 
 
+@functools.lru_cache(maxsize=None)
 def _compile_regex(string):
     """Generate the regex for label checking"""
     # Escape * for T2*
@@ -75,299 +160,385 @@ def _compile_regex(string):
 
 
 # Anatomy, T1
+ANATOMY_T1_REGEXES = [
+    re.compile('t1', re.IGNORECASE),
+    re.compile('t1w', re.IGNORECASE),
+    re.compile('(?=.*3d anat)(?![inplane])', re.IGNORECASE),
+    re.compile('(?=.*3d)(?=.*bravo)(?![inplane])', re.IGNORECASE),
+    re.compile('spgr', re.IGNORECASE),
+    re.compile('tfl', re.IGNORECASE),
+    re.compile('mprage', re.IGNORECASE),
+    re.compile('(?=.*mm)(?=.*iso)', re.IGNORECASE),
+    re.compile('(?=.*mp)(?=.*rage)', re.IGNORECASE)
+]
+
 def is_anatomy_t1(label):
-    regexes = [
-        re.compile('t1', re.IGNORECASE),
-        re.compile('t1w', re.IGNORECASE),
-        re.compile('(?=.*3d anat)(?![inplane])', re.IGNORECASE),
-        re.compile('(?=.*3d)(?=.*bravo)(?![inplane])', re.IGNORECASE),
-        re.compile('spgr', re.IGNORECASE),
-        re.compile('tfl', re.IGNORECASE),
-        re.compile('mprage', re.IGNORECASE),
-        re.compile('(?=.*mm)(?=.*iso)', re.IGNORECASE),
-        re.compile('(?=.*mp)(?=.*rage)', re.IGNORECASE)
-    ]
-    return regex_search_label(regexes, label)
+    return regex_search_label(ANATOMY_T1_REGEXES, label, 'is_anatomy_t1')
 
 # Anatomy, T2
+ANATOMY_T2_REGEXES = [
+    re.compile('t2[^*]*$', re.IGNORECASE)
+]
+
 def is_anatomy_t2(label):
-    regexes = [
-        re.compile('t2[^*]*$', re.IGNORECASE)
-    ]
-    return regex_search_label(regexes, label)
+    return regex_search_label(ANATOMY_T2_REGEXES, label, 'is_anatomy_t2')
 
 # Aanatomy, Inplane
+ANATOMY_INPLANE_REGEXES = [
+    re.compile('inplane', re.IGNORECASE)
+]
+
 def is_anatomy_inplane(label):
-    regexes = [
-        re.compile('inplane', re.IGNORECASE)
-    ]
-    return regex_search_label(regexes, label)
+    return regex_search_label(ANATOMY_INPLANE_REGEXES, label, 'is_anatomy_inplane')
 
 # Anatomy, other
+ANATOMY_REGEXES = [
+    re.compile('(?=.*IR)(?=.*EPI)', re.IGNORECASE),
+    re.compile('flair', re.IGNORECASE)
+]
+
 def is_anatomy(label):
-    regexes = [
-        re.compile('(?=.*IR)(?=.*EPI)', re.IGNORECASE),
-        re.compile('flair', re.IGNORECASE)
-    ]
-    return regex_search_label(regexes, label)
+    return regex_search_label(ANATOMY_REGEXES, label, 'is_anatomy')
 
 # Diffusion
+DIFFUSION_REGEXES = [
+    re.compile('dti', re.IGNORECASE),
+    re.compile('dwi', re.IGNORECASE),
+    re.compile('diff_', re.IGNORECASE),
+    re.compile('diffusion', re.IGNORECASE),
+    re.compile('(?=.*diff)(?=.*dir)', re.IGNORECASE),
+    re.compile('hardi', re.IGNORECASE)
+]
+
 def is_diffusion(label):
-    regexes = [
-        re.compile('dti', re.IGNORECASE),
-        re.compile('dwi', re.IGNORECASE),
-        re.compile('diff_', re.IGNORECASE),
-        re.compile('diffusion', re.IGNORECASE),
-        re.compile('(?=.*diff)(?=.*dir)', re.IGNORECASE),
-        re.compile('hardi', re.IGNORECASE)
-        ]
-    return regex_search_label(regexes, label)
+    return regex_search_label(DIFFUSION_REGEXES, label, 'is_diffusion')
 
 # Diffusion - Derived
+DIFFUSION_DERIVED_REGEXES = [
+    re.compile('_ADC$', re.IGNORECASE),
+    re.compile('_TRACEW$', re.IGNORECASE),
+    re.compile('_ColFA$', re.IGNORECASE),
+    re.compile('_FA$', re.IGNORECASE),
+    re.compile('_EXP$', re.IGNORECASE)
+]
+
 def is_diffusion_derived(label):
-    regexes = [
-        re.compile('_ADC$', re.IGNORECASE),
-        re.compile('_TRACEW$', re.IGNORECASE),
-        re.compile('_ColFA$', re.IGNORECASE),
-        re.compile('_FA$', re.IGNORECASE),
-        re.compile('_EXP$', re.IGNORECASE)
-        ]
-    return regex_search_label(regexes, label)
+    return regex_search_label(DIFFUSION_DERIVED_REGEXES, label, 'is_diffusion_derived')
 
 # Functional
+FUNCTIONAL_REGEXES = [
+    re.compile('functional', re.IGNORECASE),
+    re.compile('fmri', re.IGNORECASE),
+    re.compile('func', re.IGNORECASE),
+    re.compile('bold', re.IGNORECASE),
+    re.compile('resting', re.IGNORECASE),
+    re.compile('(?=.*rest)(?=.*state)', re.IGNORECASE),
+    # NON-STANDARD
+    re.compile('(?=.*ret)(?=.*bars)', re.IGNORECASE),
+    re.compile('(?=.*ret)(?=.*wedges)', re.IGNORECASE),
+    re.compile('(?=.*ret)(?=.*rings)', re.IGNORECASE),
+    re.compile('(?=.*ret)(?=.*check)', re.IGNORECASE),
+    re.compile('go-no-go', re.IGNORECASE),
+    re.compile('words', re.IGNORECASE),
+    re.compile('checkers', re.IGNORECASE),
+    re.compile('retinotopy', re.IGNORECASE),
+    re.compile('faces', re.IGNORECASE),
+    re.compile('rings', re.IGNORECASE),
+    re.compile('wedges', re.IGNORECASE),
+    re.compile('emoreg', re.IGNORECASE),
+    re.compile('conscious', re.IGNORECASE),
+    re.compile('^REST$'),
+    re.compile('ep2d', re.IGNORECASE),
+    re.compile('task', re.IGNORECASE),
+    re.compile('rest', re.IGNORECASE),
+    re.compile('fBIRN', re.IGNORECASE),
+    re.compile('^Curiosity', re.IGNORECASE),
+    re.compile('^DD_', re.IGNORECASE),
+    re.compile('^Poke', re.IGNORECASE),
+    re.compile('^Effort', re.IGNORECASE),
+    re.compile('emotion|conflict', re.IGNORECASE)
+]
+
 def is_functional(label):
-    regexes = [
-        re.compile('functional', re.IGNORECASE),
-        re.compile('fmri', re.IGNORECASE),
-        re.compile('func', re.IGNORECASE),
-        re.compile('bold', re.IGNORECASE),
-        re.compile('resting', re.IGNORECASE),
-        re.compile('(?=.*rest)(?=.*state)', re.IGNORECASE),
-        # NON-STANDARD
-        re.compile('(?=.*ret)(?=.*bars)', re.IGNORECASE),
-        re.compile('(?=.*ret)(?=.*wedges)', re.IGNORECASE),
-        re.compile('(?=.*ret)(?=.*rings)', re.IGNORECASE),
-        re.compile('(?=.*ret)(?=.*check)', re.IGNORECASE),
-        re.compile('go-no-go', re.IGNORECASE),
-        re.compile('words', re.IGNORECASE),
-        re.compile('checkers', re.IGNORECASE),
-        re.compile('retinotopy', re.IGNORECASE),
-        re.compile('faces', re.IGNORECASE),
-        re.compile('rings', re.IGNORECASE),
-        re.compile('wedges', re.IGNORECASE),
-        re.compile('emoreg', re.IGNORECASE),
-        re.compile('conscious', re.IGNORECASE),
-        re.compile('^REST$'),
-        re.compile('ep2d', re.IGNORECASE),
-        re.compile('task', re.IGNORECASE),
-        re.compile('rest', re.IGNORECASE),
-        re.compile('fBIRN', re.IGNORECASE),
-        re.compile('^Curiosity', re.IGNORECASE),
-        re.compile('^DD_', re.IGNORECASE),
-        re.compile('^Poke', re.IGNORECASE),
-        re.compile('^Effort', re.IGNORECASE),
-        re.compile('emotion|conflict', re.IGNORECASE)
-        ]
-    return regex_search_label(regexes, label)
+    return regex_search_label(FUNCTIONAL_REGEXES, label, 'is_functional')
 
 # Functional, Derived
+FUNCTIONAL_DERIVED_REGEXES = [
+    re.compile('mocoseries', re.IGNORECASE),
+    re.compile('GLM$', re.IGNORECASE),
+    re.compile('t-map', re.IGNORECASE),
+    re.compile('design', re.IGNORECASE),
+    re.compile('StartFMRI', re.IGNORECASE)
+]
+
 def is_functional_derived(label):
-    regexes = [
-        re.compile('mocoseries', re.IGNORECASE),
-        re.compile('GLM$', re.IGNORECASE),
-        re.compile('t-map', re.IGNORECASE),
-        re.compile('design', re.IGNORECASE),
-        re.compile('StartFMRI', re.IGNORECASE)
-        ]
-    return regex_search_label(regexes, label)
+    return regex_search_label(FUNCTIONAL_DERIVED_REGEXES, label, 'is_functional_derived')
 
 # Localizer
+LOCALIZER_REGEXES = [
+    re.compile('localizer', re.IGNORECASE),
+    re.compile('localiser', re.IGNORECASE),
+    re.compile('survey', re.IGNORECASE),
+    re.compile('loc\.', re.IGNORECASE),
+    re.compile(r'\bscout\b', re.IGNORECASE),
+    re.compile('(?=.*plane)(?=.*loc)', re.IGNORECASE),
+    re.compile('(?=.*plane)(?=.*survey)', re.IGNORECASE),
+    re.compile('3-plane', re.IGNORECASE),
+    re.compile('^loc*', re.IGNORECASE),
+    re.compile('Scout', re.IGNORECASE),
+    re.compile('AdjGre', re.IGNORECASE)
+]
+
 def is_localizer(label):
-    regexes = [
-        re.compile('localizer', re.IGNORECASE),
-        re.compile('localiser', re.IGNORECASE),
-        re.compile('survey', re.IGNORECASE),
-        re.compile('loc\.', re.IGNORECASE),
-        re.compile(r'\bscout\b', re.IGNORECASE),
-        re.compile('(?=.*plane)(?=.*loc)', re.IGNORECASE),
-        re.compile('(?=.*plane)(?=.*survey)', re.IGNORECASE),
-        re.compile('3-plane', re.IGNORECASE),
-        re.compile('^loc*', re.IGNORECASE),
-        re.compile('Scout', re.IGNORECASE),
-        re.compile('AdjGre', re.IGNORECASE)
-        ]
-    return regex_search_label(regexes, label)
+    return regex_search_label(LOCALIZER_REGEXES, label, 'is_localizer')
 
 # Shim
+SHIM_REGEXES = [
+    re.compile('(?=.*HO)(?=.*shim)', re.IGNORECASE), # Contians 'ho' and 'shim'
+    re.compile(r'\bHOS\b', re.IGNORECASE),
+    re.compile('_HOS_', re.IGNORECASE),
+    re.compile('.*shim', re.IGNORECASE)
+]
+
 def is_shim(label):
-    regexes = [
-        re.compile('(?=.*HO)(?=.*shim)', re.IGNORECASE), # Contians 'ho' and 'shim'
-        re.compile(r'\bHOS\b', re.IGNORECASE),
-        re.compile('_HOS_', re.IGNORECASE),
-        re.compile('.*shim', re.IGNORECASE)
-        ]
-    return regex_search_label(regexes, label)
+    return regex_search_label(SHIM_REGEXES, label, 'is_shim')
 
 # Fieldmap
+FIELDMAP_REGEXES = [
+    re.compile('(?=.*field)(?=.*map)', re.IGNORECASE),
+    re.compile('(?=.*bias)(?=.*ch)', re.IGNORECASE),
+    re.compile('field', re.IGNORECASE),
+    re.compile('fmap', re.IGNORECASE),
+    re.compile('topup', re.IGNORECASE),
+    re.compile('DISTORTION', re.IGNORECASE),
+    re.compile('se[-_][aprl]{2}$', re.IGNORECASE)
+]
+
 def is_fieldmap(label):
-    regexes = [
-        re.compile('(?=.*field)(?=.*map)', re.IGNORECASE),
-        re.compile('(?=.*bias)(?=.*ch)', re.IGNORECASE),
-        re.compile('field', re.IGNORECASE),
-        re.compile('fmap', re.IGNORECASE),
-        re.compile('topup', re.IGNORECASE),
-        re.compile('DISTORTION', re.IGNORECASE),
-        re.compile('se[-_][aprl]{2}$', re.IGNORECASE)
-        ]
-    return regex_search_label(regexes, label)
+    return regex_search_label(FIELDMAP_REGEXES, label, 'is_fieldmap')
 
 # Calibration
+CALIBRATION_REGEXES = [
+    re.compile('(?=.*asset)(?=.*cal)', re.IGNORECASE),
+    re.compile('^asset$', re.IGNORECASE),
+    re.compile('calibration', re.IGNORECASE)
+]
+
 def is_calibration(label):
-    regexes = [
-        re.compile('(?=.*asset)(?=.*cal)', re.IGNORECASE),
-        re.compile('^asset$', re.IGNORECASE),
-        re.compile('calibration', re.IGNORECASE)
-        ]
-    return regex_search_label(regexes, label)
+    return regex_search_label(CALIBRATION_REGEXES, label, 'is_calibration')
 
 # Coil Survey
+COIL_SURVEY_REGEXES = [
+    re.compile('(?=.*coil)(?=.*survey)', re.IGNORECASE)
+]
+
 def is_coil_survey(label):
-    regexes = [
-        re.compile('(?=.*coil)(?=.*survey)', re.IGNORECASE)
-        ]
-    return regex_search_label(regexes, label)
+    return regex_search_label(COIL_SURVEY_REGEXES, label, 'is_coil_survey')
 
 # Perfusion: Arterial Spin Labeling
+PERFUSION_REGEXES = [
+    re.compile('asl', re.IGNORECASE),
+    re.compile('(?=.*blood)(?=.*flow)', re.IGNORECASE),
+    re.compile('(?=.*art)(?=.*spin)', re.IGNORECASE),
+    re.compile('tof', re.IGNORECASE),
+    re.compile('perfusion', re.IGNORECASE),
+    re.compile('angio', re.IGNORECASE),
+]
+
 def is_perfusion(label):
-    regexes = [
-        re.compile('asl', re.IGNORECASE),
-        re.compile('(?=.*blood)(?=.*flow)', re.IGNORECASE),
-        re.compile('(?=.*art)(?=.*spin)', re.IGNORECASE),
-        re.compile('tof', re.IGNORECASE),
-        re.compile('perfusion', re.IGNORECASE),
-        re.compile('angio', re.IGNORECASE),
-        ]
-    return regex_search_label(regexes, label)
+    return regex_search_label(PERFUSION_REGEXES, label, 'is_perfusion')
 
 # Proton Density
+PROTON_DENSITY_REGEXES = [
+    re.compile('^PD$'),
+    re.compile('(?=.*proton)(?=.*density)', re.IGNORECASE),
+    re.compile('pd_'),
+    re.compile('_pd')
+]
+
 def is_proton_density(label):
-    regexes = [
-        re.compile('^PD$'),
-        re.compile('(?=.*proton)(?=.*density)', re.IGNORECASE),
-        re.compile('pd_'),
-        re.compile('_pd')
-        ]
-    return regex_search_label(regexes, label)
+    return regex_search_label(PROTON_DENSITY_REGEXES, label, 'is_proton_density')
 
 # Phase Map
+PHASE_MAP_REGEXES = [
+    re.compile('(?=.*phase)(?=.*map)', re.IGNORECASE),
+    re.compile('^phase$', re.IGNORECASE)
+]
+
 def is_phase_map(label):
-    regexes = [
-        re.compile('(?=.*phase)(?=.*map)', re.IGNORECASE),
-        re.compile('^phase$', re.IGNORECASE)
-        ]
-    return regex_search_label(regexes, label)
+    return regex_search_label(PHASE_MAP_REGEXES, label, 'is_phase_map')
 
 # Screen Save / Screenshot
+SCREENSHOT_REGEXES = [
+    re.compile('(?=.*screen)(?=.*save)', re.IGNORECASE),
+    re.compile('.*screenshot', re.IGNORECASE),
+    re.compile('.*screensave', re.IGNORECASE)
+]
+
 def is_screenshot(label):
-    regexes = [
-        re.compile('(?=.*screen)(?=.*save)', re.IGNORECASE),
-        re.compile('.*screenshot', re.IGNORECASE),
-        re.compile('.*screensave', re.IGNORECASE)
-        ]
-    return regex_search_label(regexes, label)
+    return regex_search_label(SCREENSHOT_REGEXES, label, 'is_screenshot')
 
 
 
 # Utility:  Check a list of regexes for truthyness
-def regex_search_label(regexes, label):
+def regex_search_label(regexes, label, rule=None):
+    if _profile is not None:
+        return _profile.search_label(regexes, label, rule)
     if any(regex.search(label) for regex in regexes):
             return True
     else:
             return False
 
 # Spectroscopy
+SPECTROSCOPY_REGEXES = [
+    re.compile('mrs', re.IGNORECASE),
+    re.compile('svs', re.IGNORECASE),
+    re.compile('gaba', re.IGNORECASE),
+    re.compile('csi', re.IGNORECASE),
+    re.compile('nfl', re.IGNORECASE),
+    re.compile('mega', re.IGNORECASE),
+    re.compile('press', re.IGNORECASE),
+    re.compile('spect', re.IGNORECASE)
+]
+
 def is_spectroscopy(label):
-    regexes = [
-        re.compile('mrs', re.IGNORECASE),
-        re.compile('svs', re.IGNORECASE),
-        re.compile('gaba', re.IGNORECASE),
-        re.compile('csi', re.IGNORECASE),
-        re.compile('nfl', re.IGNORECASE),
-        re.compile('mega', re.IGNORECASE),
-        re.compile('press', re.IGNORECASE),
-        re.compile('spect', re.IGNORECASE)
-        ]
-    return regex_search_label(regexes, label)
+    return regex_search_label(SPECTROSCOPY_REGEXES, label, 'is_spectroscopy')
 
 # Susceptability
+SUSCEPTABILITY_REGEXES = [
+    re.compile('swi', re.IGNORECASE),
+    re.compile('mag_images', re.IGNORECASE),
+    re.compile('pha_images', re.IGNORECASE),
+    re.compile('mip_images', re.IGNORECASE)
+]
+
 def is_susceptability(label):
-    regexes = [
-        re.compile('swi', re.IGNORECASE),
-        re.compile('mag_images', re.IGNORECASE),
-        re.compile('pha_images', re.IGNORECASE),
-        re.compile('mip_images', re.IGNORECASE)
-        ]
-    return regex_search_label(regexes, label)
+    return regex_search_label(SUSCEPTABILITY_REGEXES, label, 'is_susceptability')
+
+
+# Primary categories in order of precedence: the first rule whose predicate
+# matches the label sets the base classification.
+PRIMARY_RULES = [
+    (is_anatomy_inplane, ANATOMY_INPLANE_REGEXES,
+     {'Intent': ['Structural'], 'Measurement': ['T1'], 'Features': ['In-Plane']}),
+    (is_fieldmap, FIELDMAP_REGEXES,
+     {'Intent': ['Fieldmap'], 'Measurement': ['B0']}),
+    (is_diffusion_derived, DIFFUSION_DERIVED_REGEXES,
+     {'Intent': ['Structural'], 'Measurement': ['Diffusion'], 'Features': ['Derived']}),
+    (is_diffusion, DIFFUSION_REGEXES,
+     {'Intent': ['Structural'], 'Measurement': ['Diffusion']}),
+    (is_functional_derived, FUNCTIONAL_DERIVED_REGEXES,
+     {'Intent': ['Functional'], 'Features': ['Derived']}),
+    (is_functional, FUNCTIONAL_REGEXES,
+     {'Intent': ['Functional'], 'Measurement': ['T2*']}),
+    (is_anatomy_t2, ANATOMY_T2_REGEXES,
+     {'Intent': ['Structural'], 'Measurement': ['T2']}),
+    (is_anatomy_t1, ANATOMY_T1_REGEXES,
+     {'Intent': ['Structural'], 'Measurement': ['T1']}),
+    (is_anatomy, ANATOMY_REGEXES,
+     {'Intent': ['Structural']}),
+    (is_localizer, LOCALIZER_REGEXES,
+     {'Intent': ['Localizer'], 'Measurement': ['T2']}),
+    (is_shim, SHIM_REGEXES,
+     {'Intent': ['Shim']}),
+    (is_calibration, CALIBRATION_REGEXES,
+     {'Intent': ['Calibration']}),
+    (is_coil_survey, COIL_SURVEY_REGEXES,
+     {'Intent': ['Calibration'], 'Measurement': ['B1']}),
+    (is_proton_density, PROTON_DENSITY_REGEXES,
+     {'Intent': ['Structural'], 'Measurement': ['PD']}),
+    (is_perfusion, PERFUSION_REGEXES,
+     {'Measurement': ['Perfusion']}),
+    (is_susceptability, SUSCEPTABILITY_REGEXES,
+     {'Measurement': ['Susceptability']}),
+    (is_spectroscopy, SPECTROSCOPY_REGEXES,
+     {'Intent': ['Spectroscopy']}),
+    (is_phase_map, PHASE_MAP_REGEXES,
+     {'Custom': ['Phase Map']}),
+    (is_screenshot, SCREENSHOT_REGEXES,
+     {'Intent': ['Screenshot']}),
+]
+
+
+# A pattern made only of lookaheads for plain words, like (?=.*ret)(?=.*bars)
+_WORD_LOOKAHEADS = re.compile(r'(?:\(\?=\.\*[^()\\\[\]|?*+{}^$.]+\))+')
+
+
+def _linear_pattern(pattern):
+    """
+    Rewrite a pattern into one that is found in the same labels, but without
+    retrying .* from every position of the label.
+    """
+    if _WORD_LOOKAHEADS.fullmatch(pattern):
+        # If the words follow some position, they follow the start of its line
+        return r'(?<![^\n])' + pattern
+    if pattern.startswith('.*') and len(pattern) > 2 and pattern[2] not in '*+?{':
+        # A leading .* can always match nothing
+        return pattern[2:]
+    return pattern
+
+
+def compile_primary_matcher(rules):
+    """
+    Compile the regexes of all rules into a single regex matched at the start
+    of the label. Each rule becomes a lookahead alternative that succeeds if
+    any of its regexes would be found somewhere in the label, followed by an
+    empty named group. Alternatives are tried in order, so the group of the
+    match is that of the highest-precedence rule.
+    """
+    alternatives = []
+    for index, (_, regexes, _) in enumerate(rules):
+        patterns = '|'.join(
+            ('(?i:%s)' if regex.flags & re.IGNORECASE else '(?:%s)') % _linear_pattern(regex.pattern)
+            for regex in regexes
+        )
+        alternatives.append(r'(?=[\s\S]*?(?:%s))(?P<rule%d>)' % (patterns, index))
+    return re.compile('|'.join(alternatives))
+
+
+_primary_matcher = compile_primary_matcher(PRIMARY_RULES)
+
+
+def primary_rule(label):
+    """Return the index in PRIMARY_RULES of the rule matching label, or None."""
+    if _profile is not None:
+        # Walk the predicates so that each of them gets profiled
+        return primary_rule_chain(label)
+    match = _primary_matcher.match(label)
+    if match is None:
+        return None
+    return int(match.lastgroup[len('rule'):])
+
+
+def primary_rule_chain(label):
+    """Reference for primary_rule: call the predicates one after the other."""
+    for index, (predicate, _, _) in enumerate(PRIMARY_RULES):
+        if predicate(label):
+            return index
+    return None
 
 
 # Call all functions to determine new label
 def infer_classification(label):
+    return _classify(label, primary_rule)
+
+
+def infer_classification_chain(label):
+    """Reference for infer_classification, calling the predicates in turn."""
+    return _classify(label, primary_rule_chain)
+
+
+def _classify(label, find_primary_rule):
     if not label:
         return {}
     else:
-        classification = {}
-        if is_anatomy_inplane(label):
-            classification['Intent'] = ['Structural']
-            classification['Measurement'] = ['T1']
-            classification['Features'] = ['In-Plane']
-        elif is_fieldmap(label):
-            classification['Intent'] = ['Fieldmap']
-            classification['Measurement'] = ['B0']
-        elif is_diffusion_derived(label):
-            classification['Intent'] = ['Structural']
-            classification['Measurement'] = ['Diffusion']
-            classification['Features'] = ['Derived']
-        elif is_diffusion(label):
-            classification['Intent'] = ['Structural']
-            classification['Measurement'] = ['Diffusion']
-        elif is_functional_derived(label):
-            classification['Intent'] = ['Functional']
-            classification['Features'] = ['Derived']
-        elif is_functional(label):
-            classification['Intent'] = ['Functional']
-            classification['Measurement'] = ['T2*']
-        elif is_anatomy_t2(label):
-            classification['Intent'] = ['Structural']
-            classification['Measurement'] = ['T2']
-        elif is_anatomy_t1(label):
-            classification['Intent'] = ['Structural']
-            classification['Measurement'] = ['T1']
-        elif is_anatomy(label):
-            classification['Intent'] = ['Structural']
-        elif is_localizer(label):
-            classification['Intent'] = ['Localizer']
-            classification['Measurement'] = ['T2']
-        elif is_shim(label):
-            classification['Intent'] = ['Shim']
-        elif is_calibration(label):
-            classification['Intent'] = ['Calibration']
-        elif is_coil_survey(label):
-            classification['Intent'] = ['Calibration']
-            classification['Measurement'] = ['B1']
-        elif is_proton_density(label):
-            classification['Intent'] = ['Structural']
-            classification['Measurement'] = ['PD']
-        elif is_perfusion(label):
-            classification['Measurement'] = ['Perfusion']
-        elif is_susceptability(label):
-            classification['Measurement'] = ['Susceptability']
-        elif is_spectroscopy(label):
-            classification['Intent'] = ['Spectroscopy']
-        elif is_phase_map(label):
-            classification['Custom'] = ['Phase Map']
-        elif is_screenshot(label):
-            classification['Intent'] = ['Screenshot']
+        rule = find_primary_rule(label)
+        if rule is not None:
+            classification = dict(
+                (key, list(values)) for key, values in PRIMARY_RULES[rule][2].items()
+            )
         else:
+            classification = {}
             print(label.strip('\n') + ' --->>>> unknown')
 
 
@@ -393,3 +564,25 @@ def infer_classification(label):
             classification['Intent'] = class_intent
 
     return classification
+
+
+if __name__ == '__main__':
+    import argparse
+
+    ap = argparse.ArgumentParser(description='Infer the classification of labels, one per line.')
+    ap.add_argument('labels', help='file with one label per line, - for stdin')
+    ap.add_argument('--profile', action='store_true',
+                    help='report per rule and per pattern statistics on stderr after the batch')
+    args = ap.parse_args()
+
+    if args.profile:
+        enable_profiling()
+
+    label_file = sys.stdin if args.labels == '-' else open(args.labels)
+    with label_file:
+        for line in label_file:
+            label = line.rstrip('\n')
+            print('%s: %s' % (label, infer_classification(label)))
+
+    if args.profile:
+        disable_profiling().report(sys.stderr)
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+'''
+Infer acquisition classification from the acquisition parameters of the
+DICOM header: echo, repetition and inversion times, diffusion b-value,
+scanning sequence and image type.
+
+The rules are threshold tables, evaluated with NumPy over arrays holding
+the parameters of any number of acquisitions at once:
+
+    values, flags = parameter_arrays(headers)
+    classifications = classify_arrays(values, flags)
+'''
+
+import re
+import threading
+import numpy as np
+from collections.abc import Sequence
+
+# Numeric parameters, in ms for the times and s/mm2 for the b-value
+PARAMETERS = ("EchoTime", "RepetitionTime", "InversionTime", "DiffusionBValue")
+
+# Boolean parameters: ScanningSequence values, and whether the ImageType is
+# that of a diffusion series or of a derived diffusion map
+SCANNING_SEQUENCES = ("SE", "GR", "IR", "EP")
+FLAGS = SCANNING_SEQUENCES + ("DIFFUSION", "DIFFUSION_MAP")
+
+# ImageType values of derived diffusion maps
+DIFFUSION_MAP_TYPES = ("ADC", "FA", "TRACEW")
+
+# b-value in the sequence name of Siemens diffusion series, like *ep_b1000#1
+SEQUENCE_B_VALUE = re.compile(r"ep_b(\d+)")
+
+# Rules in order of precedence: the first rule whose parameters all fall
+# within its (low, high) ranges, and whose flags have the given values, sets
+# the classification. A missing parameter is outside of any range.
+RULES = [
+    ("diffusion_map", {}, {"DIFFUSION_MAP": True},
+     {'Intent': ['Structural'], 'Measurement': ['Diffusion'], 'Features': ['Derived']}),
+    ("diffusion_image_type", {}, {"DIFFUSION": True},
+     {'Intent': ['Structural'], 'Measurement': ['Diffusion']}),
+    ("diffusion_b_value", {"DiffusionBValue": (50, np.inf)}, {},
+     {'Intent': ['Structural'], 'Measurement': ['Diffusion']}),
+    ("functional", {"EchoTime": (15, 55), "RepetitionTime": (300, 4000)}, {"EP": True, "IR": False},
+     {'Intent': ['Functional'], 'Measurement': ['T2*']}),
+    ("flair", {"InversionTime": (1500, 3500), "EchoTime": (60, np.inf)}, {"IR": True},
+     {'Intent': ['Structural'], 'Measurement': ['T2'], 'Features': ['FLAIR']}),
+    ("t1_inversion_recovery", {"InversionTime": (300, 1500), "EchoTime": (0, 15)}, {"IR": True},
+     {'Intent': ['Structural'], 'Measurement': ['T1']}),
+    ("t2_spin_echo", {"RepetitionTime": (1500, np.inf), "EchoTime": (60, np.inf)}, {"SE": True, "EP": False},
+     {'Intent': ['Structural'], 'Measurement': ['T2']}),
+    ("pd_spin_echo", {"RepetitionTime": (1500, np.inf), "EchoTime": (0, 35)}, {"SE": True, "EP": False},
+     {'Intent': ['Structural'], 'Measurement': ['PD']}),
+    ("t1_spin_echo", {"RepetitionTime": (0, 1000), "EchoTime": (0, 35)}, {"SE": True, "EP": False},
+     {'Intent': ['Structural'], 'Measurement': ['T1']}),
+    ("t2_star_gradient_echo", {"EchoTime": (15, np.inf)}, {"GR": True, "EP": False},
+     {'Intent': ['Structural'], 'Measurement': ['T2*']}),
+    ("t1_gradient_echo", {"RepetitionTime": (0, 50), "EchoTime": (0, 10)}, {"GR": True, "EP": False},
+     {'Intent': ['Structural'], 'Measurement': ['T1']}),
+]
+
+
+def compile_rules(rules=RULES):
+    """
+    Build the threshold tables of rules: the low and high bound of every
+    parameter and whether it is constrained, shaped (rules, PARAMETERS), and
+    the flags required to be set and to be unset, shaped (rules, FLAGS).
+    """
+    low = np.full((len(rules), len(PARAMETERS)), -np.inf)
+    high = np.full((len(rules), len(PARAMETERS)), np.inf)
+    constrained = np.zeros((len(rules), len(PARAMETERS)), dtype=bool)
+    required = np.zeros((len(rules), len(FLAGS)), dtype=bool)
+    forbidden = np.zeros((len(rules), len(FLAGS)), dtype=bool)
+    for r, (_, ranges, flags, _) in enumerate(rules):
+        for parameter, (lower, upper) in ranges.items():
+            p = PARAMETERS.index(parameter)
+            low[r, p], high[r, p], constrained[r, p] = lower, upper, True
+        for flag, value in flags.items():
+            f = FLAGS.index(flag)
+            if value:
+                required[r, f] = True
+            else:
+                forbidden[r, f] = True
+    return low, high, constrained, required, forbidden
+
+
+_TABLES = compile_rules()
+
+
+def _first_number(value):
+    # Multi-valued parameters, like the echo times of a multi-echo series,
+    # are represented by their first value
+    if isinstance(value, Sequence) and not isinstance(value, (str, bytes)):
+        value = value[0] if len(value) else None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _values(value):
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [v.strip().upper() for v in value.split("\\")]
+    return [str(v).strip().upper() for v in value]
+
+
+def header_parameters(header):
+    """
+    The numeric parameters and flags of a pydicom dataset, or of any mapping
+    from keywords to values such as a files entry info.
+    """
+    values = [_first_number(header.get(parameter)) for parameter in PARAMETERS]
+
+    sequence_name = str(header.get("SequenceName") or "")
+    b_value = SEQUENCE_B_VALUE.search(sequence_name)
+    b = PARAMETERS.index("DiffusionBValue")
+    if b_value and np.isnan(values[b]):
+        values[b] = float(b_value.group(1))
+
+    scanning_sequence = _values(header.get("ScanningSequence"))
+    image_type = _values(header.get("ImageType"))
+    flags = [flag in scanning_sequence for flag in SCANNING_SEQUENCES]
+    flags.append("DIFFUSION" in image_type or bool(b_value))
+    flags.append(any(t in image_type for t in DIFFUSION_MAP_TYPES))
+    return values, flags
+
+
+def parameter_arrays(headers):
+    """
+    Collect the parameters of headers into a float array of values, NaN when
+    missing, shaped (headers, PARAMETERS) and a bool array of flags shaped
+    (headers, FLAGS).
+    """
+    values = []
+    flags = []
+    for header in headers:
+        header_values, header_flags = header_parameters(header)
+        values.append(header_values)
+        flags.append(header_flags)
+    values = np.array(values, dtype=float).reshape(-1, len(PARAMETERS))
+    flags = np.array(flags, dtype=bool).reshape(-1, len(FLAGS))
+    return values, flags
+
+
+def match_rules(values, flags, tables=None):
+    """
+    Return the index in RULES of the first rule matching each row of values
+    and flags, or -1 for the rows no rule matches.
+    """
+    low, high, constrained, required, forbidden = tables or _TABLES
+    # Comparisons with NaN are false: a missing parameter fails every range
+    with np.errstate(invalid="ignore"):
+        in_range = (values[:, None, :] >= low) & (values[:, None, :] <= high)
+    numeric_match = (in_range | ~constrained).all(axis=2)
+    flags = flags[:, None, :]
+    flag_match = ~((required & ~flags) | (forbidden & flags)).any(axis=2)
+    matches = numeric_match & flag_match
+    return np.where(matches.any(axis=1), matches.argmax(axis=1), -1)
+
+
+def classify_arrays(values, flags):
+    """The classification of each row of values and flags, {} if none."""
+    return [
+        _copy_classification(RULES[r][3]) if r >= 0 else {}
+        for r in match_rules(values, flags)
+    ]
+
+
+def classify_headers(headers):
+    """The classification of each of headers, in a single pass over all."""
+    return classify_arrays(*parameter_arrays(headers))
+
+
+def infer_classification(header):
+    """The classification of one header, {} if no rule matches."""
+    return classify_headers([header])[0]
+
+
+class Batch(object):
+    """
+    Headers to classify together in a single pass: add() each header with
+    the callback to call with its classification, then classify() once all
+    are added. Headers can be added from several threads.
+    """
+
+    def __init__(self):
+        self.values = []
+        self.flags = []
+        self.callbacks = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.callbacks)
+
+    def add(self, header, callback):
+        values, flags = header_parameters(header)
+        with self._lock:
+            self.values.append(values)
+            self.flags.append(flags)
+            self.callbacks.append(callback)
+
+    def classify(self):
+        """Classify the headers added so far, calling back with each classification."""
+        with self._lock:
+            values, flags, callbacks = self.values, self.flags, self.callbacks
+            self.values, self.flags, self.callbacks = [], [], []
+        if not callbacks:
+            return
+        values = np.array(values, dtype=float).reshape(-1, len(PARAMETERS))
+        flags = np.array(flags, dtype=bool).reshape(-1, len(FLAGS))
+        for callback, classification in zip(callbacks, classify_arrays(values, flags)):
+            callback(classification)
+
+
+def _copy_classification(classification):
+    return {key: list(value) for key, value in classification.items()}
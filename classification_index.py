@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+'''
+A local SQLite index of classified acquisitions.
+
+Each indexed input is recorded with its size, modification time and SHA-256
+hash, so that inputs already indexed and unchanged are skipped when indexed
+again. Each files entry of its metadata is recorded with its label,
+modality, classification and a few header fields, which can be queried:
+
+    python classification_index.py index index.db /data/*.zip
+    python classification_index.py query index.db --where Intent=Functional --where StationName=MR1
+'''
+
+import os
+import sys
+import json
+import sqlite3
+import hashlib
+import logging
+import datetime
+
+log = logging.getLogger("dicom-mr-classifier")
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Inputs classified, then indexed and committed, at a time
+BATCH_SIZE = 1000
+
+# Header fields of the files info stored in columns of their own
+HEADER_FIELDS = [
+    "StudyInstanceUID",
+    "SeriesInstanceUID",
+    "SeriesNumber",
+    "Manufacturer",
+    "ManufacturerModelName",
+    "StationName",
+    "DeviceSerialNumber",
+    "MagneticFieldStrength",
+    "EchoTime",
+    "RepetitionTime",
+]
+
+CLASSIFICATION_FIELDS = ["Intent", "Measurement", "Features", "Custom"]
+
+FILE_COLUMNS = ["label", "modality"] + HEADER_FIELDS
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS inputs (
+        path TEXT PRIMARY KEY,
+        size INTEGER,
+        mtime REAL,
+        sha256 TEXT,
+        indexed_at TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS files (
+        input_path TEXT REFERENCES inputs(path) ON DELETE CASCADE,
+        name TEXT,
+        label TEXT,
+        modality TEXT,
+        %s,
+        PRIMARY KEY (input_path, name)
+    )""" % ",\n        ".join('"%s"' % field for field in HEADER_FIELDS),
+    """CREATE TABLE IF NOT EXISTS classifications (
+        input_path TEXT,
+        name TEXT,
+        field TEXT,
+        value TEXT,
+        FOREIGN KEY (input_path, name) REFERENCES files(input_path, name) ON DELETE CASCADE
+    )""",
+    "CREATE INDEX IF NOT EXISTS classifications_value ON classifications (field, value)",
+]
+
+
+def input_stat(path):
+    """The size in bytes and latest modification time of a file or directory."""
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime
+    size = 0
+    mtime = os.stat(path).st_mtime
+    for file_path in _directory_files(path):
+        stat = os.stat(file_path)
+        size += stat.st_size
+        mtime = max(mtime, stat.st_mtime)
+    return size, mtime
+
+
+def input_hash(path):
+    """The SHA-256 of a file, or of the names and contents of a directory."""
+    sha256 = hashlib.sha256()
+    file_paths = _directory_files(path) if os.path.isdir(path) else [path]
+    for file_path in file_paths:
+        if file_path != path:
+            sha256.update(os.path.relpath(file_path, path).encode("utf-8") + b"\0")
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _directory_files(path):
+    file_paths = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        file_paths.extend(os.path.join(root, name) for name in sorted(files))
+    return file_paths
+
+
+class ClassificationIndex(object):
+    """
+    A SQLite database of classified inputs, created if missing. Use as a
+    context manager to commit on exit.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.connection.commit()
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def is_current(self, path):
+        """
+        Return True if path is indexed and has not changed since. The input
+        is only hashed when its size or modification time changed.
+        """
+        path = os.path.abspath(path)
+        row = self.connection.execute(
+            "SELECT size, mtime, sha256 FROM inputs WHERE path = ?", (path,)
+        ).fetchone()
+        if row is None:
+            return False
+        size, mtime = input_stat(path)
+        if (size, mtime) == (row[0], row[1]):
+            return True
+        if input_hash(path) != row[2]:
+            return False
+        # Touched but not modified
+        self.connection.execute(
+            "UPDATE inputs SET size = ?, mtime = ? WHERE path = ?", (size, mtime, path)
+        )
+        return True
+
+    def upsert(self, path, metadata):
+        """
+        Record the metadata of the input at path, replacing any former
+        record. The record is not committed: commit the connection, or use
+        the index as a context manager.
+        """
+        path = os.path.abspath(path)
+        size, mtime = input_stat(path)
+        sha256 = input_hash(path)
+        # A savepoint within the open transaction keeps the record whole
+        # without committing it
+        if not self.connection.in_transaction:
+            self.connection.execute("BEGIN")
+        self.connection.execute("SAVEPOINT upsert")
+        try:
+            self._insert(path, size, mtime, sha256, metadata)
+        except Exception:
+            self.connection.execute("ROLLBACK TO upsert")
+            raise
+        finally:
+            self.connection.execute("RELEASE upsert")
+
+    def _insert(self, path, size, mtime, sha256, metadata):
+        # Replacing the input deletes its files and classifications
+        self.connection.execute("DELETE FROM inputs WHERE path = ?", (path,))
+        self.connection.execute(
+            "INSERT INTO inputs VALUES (?, ?, ?, ?, ?)",
+            (path, size, mtime, sha256, datetime.datetime.utcnow().isoformat()),
+        )
+        acquisition = metadata.get("acquisition", {})
+        for dicom_file in acquisition.get("files", []):
+            info = dicom_file.get("info", {})
+            row = [path, dicom_file.get("name"), acquisition.get("label"), dicom_file.get("modality")]
+            row += [_column_value(info.get(field)) for field in HEADER_FIELDS]
+            self.connection.execute(
+                "INSERT INTO files VALUES (%s)" % ", ".join("?" * len(row)), row
+            )
+            classification = dicom_file.get("classification") or {}
+            for field, values in classification.items():
+                for value in values:
+                    self.connection.execute(
+                        "INSERT INTO classifications VALUES (?, ?, ?, ?)",
+                        (path, dicom_file.get("name"), field, value),
+                    )
+
+    def query(self, **where):
+        """
+        Yield a dict for every indexed files entry whose classification
+        fields (Intent, Measurement, Features, Custom) or columns (label,
+        modality and HEADER_FIELDS) equal the given values.
+        """
+        conditions = []
+        parameters = []
+        for key, value in sorted(where.items()):
+            if key in CLASSIFICATION_FIELDS:
+                conditions.append(
+                    "EXISTS (SELECT 1 FROM classifications c WHERE c.input_path = f.input_path"
+                    " AND c.name = f.name AND c.field = ? AND c.value = ?)"
+                )
+                parameters += [key, value]
+            elif key in HEADER_FIELDS:
+                values = _query_values(value)
+                conditions.append("(%s)" % " OR ".join(['f."%s" = ?' % key] * len(values)))
+                parameters += values
+            elif key in FILE_COLUMNS:
+                conditions.append('f."%s" = ?' % key)
+                parameters.append(value)
+            else:
+                raise ValueError("Cannot query by %s" % key)
+        sql = "SELECT f.* FROM files f"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY f.input_path, f.name"
+
+        cursor = self.connection.execute(sql, parameters)
+        columns = [column[0] for column in cursor.description]
+        for row in cursor.fetchall():
+            entry = dict(zip(columns, row))
+            entry["classification"] = self._classification(entry["input_path"], entry["name"])
+            yield entry
+
+    def _classification(self, input_path, name):
+        classification = {}
+        for field, value in self.connection.execute(
+            "SELECT field, value FROM classifications WHERE input_path = ? AND name = ? ORDER BY rowid",
+            (input_path, name),
+        ):
+            classification.setdefault(field, []).append(value)
+        return classification
+
+
+def _column_value(value):
+    # Multi-valued header fields are stored as JSON
+    if isinstance(value, (list, dict)):
+        return json.dumps(value)
+    return value
+
+
+def _query_values(value):
+    # Header field columns hold numeric VRs as numbers and string VRs as
+    # text, even when the text looks like a number (e.g. a StationName of
+    # '007'): match a value in both forms
+    values = [value if isinstance(value, str) else str(value)]
+    for number in (int, float):
+        try:
+            values.append(number(value))
+            break
+        except (TypeError, ValueError):
+            pass
+    return values
+
+
+def index_inputs(index, paths, timezone=None, config=None):
+    """
+    Classify and index every input of paths that is not indexed yet or has
+    changed since. Inputs are classified BATCH_SIZE at a time, those
+    classified from their acquisition parameters in one pass per batch, and
+    committed batch by batch. Returns the number of inputs indexed.
+    """
+    import dicom_mr_classifier
+    import classification_from_parameters
+
+    indexed = 0
+    for start in range(0, len(paths), BATCH_SIZE):
+        classified = []
+        parameter_batch = classification_from_parameters.Batch()
+        for path in paths[start:start + BATCH_SIZE]:
+            try:
+                # Inputs indexed before may have been removed since
+                if index.is_current(path):
+                    log.info("%s is already indexed" % path)
+                    continue
+                metadata = dicom_mr_classifier.classify_input(
+                    path, timezone, config, parameter_batch=parameter_batch
+                )
+            except (dicom_mr_classifier.ClassificationError, IOError) as e:
+                log.warning("skipping %s: %s" % (path, e))
+                continue
+            classified.append((path, metadata))
+        parameter_batch.classify()
+        for path, metadata in classified:
+            index.upsert(path, metadata)
+        index.connection.commit()
+        indexed += len(classified)
+    return indexed
+
+
+if __name__ == "__main__":
+    import argparse
+
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--log_level", help="logging level", default="info")
+    commands = ap.add_subparsers(dest="command")
+
+    index_command = commands.add_parser("index", help="classify and index inputs")
+    index_command.add_argument("db", help="SQLite database file")
+    index_command.add_argument("inputs", nargs="*", help="zip, tar, directory or file inputs")
+    index_command.add_argument("--input-list", help="file listing inputs one per line, - for stdin")
+    index_command.add_argument("--config-file", help="configuration file with custom classifications")
+
+    query_command = commands.add_parser("query", help="list the indexed files entries")
+    query_command.add_argument("db", help="SQLite database file")
+    query_command.add_argument(
+        "--where",
+        action="append",
+        default=[],
+        metavar="FIELD=VALUE",
+        help="classification field (%s), or one of: %s"
+        % (", ".join(CLASSIFICATION_FIELDS), ", ".join(FILE_COLUMNS)),
+    )
+    query_command.add_argument("--json", action="store_true", help="print JSON lines")
+    args = ap.parse_args()
+
+    logging.basicConfig()
+    log.setLevel(getattr(logging, args.log_level.upper()))
+
+    if args.command == "index":
+        import tzlocal
+        import dicom_mr_classifier
+
+        paths = list(args.inputs)
+        if args.input_list:
+            with (sys.stdin if args.input_list == "-" else open(args.input_list)) as f:
+                paths += [line.strip() for line in f if line.strip()]
+        config = None
+        if args.config_file:
+            with open(args.config_file) as f:
+                config = json.load(f)
+        timezone = dicom_mr_classifier.validate_timezone(tzlocal.get_localzone())
+        with ClassificationIndex(args.db) as index:
+            indexed = index_inputs(index, paths, timezone, config)
+        log.info("indexed %d of %d inputs" % (indexed, len(paths)))
+
+    elif args.command == "query":
+        where = dict(condition.split("=", 1) for condition in args.where)
+        with ClassificationIndex(args.db) as index:
+            for entry in index.query(**where):
+                if args.json:
+                    print(json.dumps(entry))
+                else:
+                    classification = "; ".join(
+                        "%s=%s" % (field, ",".join(values))
+                        for field, values in entry["classification"].items()
+                    )
+                    print("\t".join(str(entry[column]) for column in ["input_path", "name", "label", "modality"])
+                          + "\t" + classification)
+
+    else:
+        ap.print_help()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+'''
+Compiled classification rules for long-running processes, reloaded without
+a restart when their source files change.
+
+    rules = classification_rules.ReloadingRules(custom_path="classifications.json")
+    rules.start()
+    metadata = dicom_mr_classifier.classify_input(path, rules=rules)
+
+The label rules are a classification_from_label.py file, the custom
+classifications a JSON file: either a gear config.json holding them as the
+classifications context, or the mapping of label patterns to
+classification strings itself.
+'''
+
+import os
+import json
+import hashlib
+import logging
+import threading
+import importlib.util
+
+import dicom_mr_classifier
+
+log = logging.getLogger("dicom-mr-classifier")
+
+LABEL_RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "classification_from_label.py")
+
+# Labels classified by a freshly compiled rule set before it is swapped in,
+# so that its regular expression caches are warm
+WARMUP_LABELS = ["T1w_MPR", "T2w_SPC", "fMRI_rest_AP", "DTI_64dir_b1000", "localizer", "field_map"]
+
+
+class RuleSet(object):
+    """
+    An immutable compiled rule set: the label rules module, the compiled
+    custom classifications (None to use the config ones) and the version,
+    a hash of their sources.
+    """
+
+    def __init__(self, label_rules, custom_classifications, version):
+        self.label_rules = label_rules
+        self.custom_classifications = custom_classifications
+        self.version = version
+
+    def custom_classification(self, label, config=None):
+        if self.custom_classifications is None:
+            return dicom_mr_classifier.get_custom_classification(label, config)
+        return dicom_mr_classifier.match_custom_classification(label, self.custom_classifications)
+
+    def infer_classification(self, label):
+        return self.label_rules.infer_classification(label)
+
+
+def load_rule_set(label_rules_path=LABEL_RULES_PATH, custom_path=None):
+    """Compile a RuleSet from its source files."""
+    sha256 = hashlib.sha256()
+    with open(label_rules_path, "rb") as f:
+        source = f.read()
+    sha256.update(source)
+    spec = importlib.util.spec_from_file_location("classification_from_label", label_rules_path)
+    label_rules = importlib.util.module_from_spec(spec)
+    exec(compile(source, label_rules_path, "exec"), label_rules.__dict__)
+
+    custom_classifications = None
+    if custom_path:
+        with open(custom_path, "rb") as f:
+            source = f.read()
+        sha256.update(source)
+        classifications = json.loads(source.decode("utf-8"))
+        if "inputs" in classifications:
+            classifications = classifications["inputs"].get("classifications", {}).get("value", {})
+        if not isinstance(classifications, dict):
+            raise ValueError("classifications must be an object!")
+        custom_classifications = dicom_mr_classifier.compile_custom_classifications(classifications)
+
+    rule_set = RuleSet(label_rules, custom_classifications, sha256.hexdigest()[:12])
+    for label in WARMUP_LABELS:
+        rule_set.infer_classification(label)
+    return rule_set
+
+
+class ReloadingRules(object):
+    """
+    The current RuleSet of a process. check() recompiles it when one of its
+    source files changed, and start() does so from a background thread
+    every interval seconds. A new rule set replaces the old one in a single
+    assignment: classifications in flight finish with the rule set they
+    started with. If the new sources fail to compile, the old rules stay.
+    """
+
+    def __init__(self, label_rules_path=LABEL_RULES_PATH, custom_path=None, interval=2.0):
+        self.label_rules_path = label_rules_path
+        self.custom_path = custom_path
+        self.interval = interval
+        self._mtimes = self._source_mtimes()
+        self.current = load_rule_set(label_rules_path, custom_path)
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def version(self):
+        return self.current.version
+
+    def _source_mtimes(self):
+        paths = [self.label_rules_path, self.custom_path]
+        return [os.stat(path).st_mtime_ns if path and os.path.exists(path) else None for path in paths]
+
+    def check(self):
+        """Reload the rules if their sources changed. Returns True if they were reloaded."""
+        mtimes = self._source_mtimes()
+        if mtimes == self._mtimes:
+            return False
+        self._mtimes = mtimes
+        try:
+            rule_set = load_rule_set(self.label_rules_path, self.custom_path)
+        except Exception:
+            log.exception("Could not reload the classification rules, keeping version %s" % self.version)
+            return False
+        if rule_set.version == self.current.version:
+            return False
+        self.current = rule_set
+        log.info("Reloaded the classification rules, version %s" % rule_set.version)
+        return True
+
+    def start(self):
+        """Watch the sources from a daemon thread."""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._watch, name="classification-rules")
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            self.check()
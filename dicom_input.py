@@ -0,0 +1,953 @@
+#!/usr/bin/env python
+'''
+Iterate over the members of a DICOM input: a zip archive, a tar archive
+(optionally gzip/bzip2/xz compressed), a directory or a single file.
+
+Members are streamed straight from the input; nothing is extracted to disk.
+Plain files and zip members stored without compression are memory-mapped.
+Of every member only the header is decoded: pixel data is skipped over, so
+memory use does not grow with the size of the images.
+'''
+
+import io
+import os
+import mmap
+import posixpath
+import time
+import shutil
+import struct
+import logging
+import tarfile
+import zipfile
+import tempfile
+import threading
+import collections
+import concurrent.futures
+
+import pydicom
+import pydicom.filereader
+
+log = logging.getLogger("dicom-mr-classifier")
+
+ZIP = "zip"
+TAR = "tar"
+DIRECTORY = "directory"
+FILE = "file"
+
+# Input kinds whose members can be visited in any order without decompressing
+# the members in between.
+RANDOM_ACCESS_KINDS = (ZIP, DIRECTORY)
+
+SPOOL_CHUNK_SIZE = 1024 * 1024
+
+# Worker threads reading members concurrently: inflating zip members and
+# parsing their headers mostly release the GIL or wait on I/O.
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+RAW_DATA_STORAGE = "1.2.840.10008.5.1.4.1.1.66"
+
+DEFLATED_TRANSFER_SYNTAX = "1.2.840.10008.1.2.1.99"
+
+# Name of the DICOMDIR file of media exports, and its record type of images
+DICOMDIR_NAME = "DICOMDIR"
+IMAGE_RECORD = "IMAGE"
+
+# The (7FE0,0010) Pixel Data tag, little and big endian
+PIXEL_DATA_TAGS = (b"\xe0\x7f\x10\x00", b"\x7f\xe0\x00\x10")
+
+
+class InputLimitError(Exception):
+    """Raised when an input exceeds one of its InputLimits."""
+
+
+class InputLimits(object):
+    """
+    Budgets of a single input, each unlimited when None: the total size of
+    its members once decompressed, the number of members, the size of a
+    member, the number of top level elements of a member header, and the
+    wall time in seconds, counted from the creation of the limits.
+    """
+
+    def __init__(
+        self,
+        max_total_size=None,
+        max_members=None,
+        max_member_size=None,
+        max_header_elements=None,
+        timeout=None,
+    ):
+        self.max_total_size = max_total_size
+        self.max_members = max_members
+        self.max_member_size = max_member_size
+        self.max_header_elements = max_header_elements
+        self.timeout = timeout
+        self.deadline = time.monotonic() + timeout if timeout else None
+
+    def check_time(self):
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise InputLimitError("Reading the input took more than %s s" % self.timeout)
+
+    def check_members(self, count, total_size):
+        """Check the number and total size of the members listed so far."""
+        if self.max_members and count > self.max_members:
+            raise InputLimitError("The input has more than %d members" % self.max_members)
+        if self.max_total_size and total_size > self.max_total_size:
+            raise InputLimitError(
+                "The input members add up to more than %d bytes" % self.max_total_size
+            )
+
+    def check_member(self, member):
+        if self.max_member_size and member.size > self.max_member_size:
+            raise InputLimitError(
+                "Member %s is larger than %d bytes" % (member.name, self.max_member_size)
+            )
+
+
+# name: path of the member within the input
+# size: uncompressed size in bytes
+# open: callable returning a readable, seekable binary file object
+# map: callable returning a MappedFile over the member bytes, or None if the
+#      member is compressed and cannot be memory-mapped
+Member = collections.namedtuple("Member", ["name", "size", "open", "map"])
+Member.__new__.__defaults__ = (None,)
+
+# An instance record of a DICOMDIR
+# name: name of the member the record references
+# series_uid: SeriesInstanceUID of the series record the instance belongs to
+# sop_class_uid: ReferencedSOPClassUIDInFile of the record
+# record_type: DirectoryRecordType of the record, e.g. IMAGE or RAW DATA
+DicomdirRecord = collections.namedtuple(
+    "DicomdirRecord", ["name", "series_uid", "sop_class_uid", "record_type"]
+)
+
+
+def input_kind(source):
+    """
+    Return the kind of input found at source, a path or a seekable binary
+    file object.
+    """
+    if not isinstance(source, str):
+        return _fileobj_kind(source)
+    if os.path.isdir(source):
+        return DIRECTORY
+    if zipfile.is_zipfile(source):
+        return ZIP
+    if tarfile.is_tarfile(source):
+        return TAR
+    return FILE
+
+
+def _fileobj_kind(fileobj):
+    try:
+        if zipfile.is_zipfile(fileobj):
+            return ZIP
+        fileobj.seek(0)
+        try:
+            with tarfile.open(fileobj=fileobj, mode="r:*"):
+                return TAR
+        except tarfile.TarError:
+            return FILE
+    finally:
+        fileobj.seek(0)
+
+
+def source_name(source):
+    """The file name of an input path or file object."""
+    if isinstance(source, str):
+        return os.path.basename(os.path.normpath(source))
+    return os.path.basename(str(getattr(source, "name", "")))
+
+
+class MappedFile(io.RawIOBase):
+    """
+    A read-only file object over a byte range of a memory map. Reads copy
+    only the bytes asked for, so parsing a header never touches the pages
+    holding the pixel data.
+    """
+
+    def __init__(self, mapping, offset, size, name, owns_mapping=False):
+        super(MappedFile, self).__init__()
+        self.name = name
+        self._mapping = mapping if owns_mapping else None
+        self._view = memoryview(mapping)[offset:offset + size]
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._view[self._pos:self._pos + len(buffer)]
+        size = len(data)
+        buffer[:size] = data
+        self._pos += size
+        return size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        if offset < 0:
+            raise ValueError("negative seek position %d" % offset)
+        self._pos = offset
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        if not self.closed:
+            self._view.release()
+            if self._mapping is not None:
+                self._mapping.close()
+        super(MappedFile, self).close()
+
+
+class ForwardFile(io.RawIOBase):
+    """
+    A seekable file object over a stream that can only be read forwards,
+    such as a tar member. The bytes read are kept so that pydicom can seek
+    back among them; seeking past them reads and drops the bytes skipped,
+    together with the kept ones.
+    """
+
+    def __init__(self, stream, size=None, name=None, owns_stream=False):
+        self._stream = stream
+        self._owns_stream = owns_stream
+        self._size = size
+        self._kept = bytearray()
+        self._kept_offset = 0
+        self._pos = 0
+        self.name = name
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        end = self._kept_offset + len(self._kept)
+        wanted = self._pos + len(buffer) - end
+        if wanted > 0:
+            self._kept += self._stream.read(wanted)
+        start = self._pos - self._kept_offset
+        data = self._kept[start:start + len(buffer)]
+        buffer[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            if self._size is None:
+                raise io.UnsupportedOperation("Cannot seek from the end of a stream")
+            offset += self._size
+        if offset < self._kept_offset:
+            raise io.UnsupportedOperation("Cannot seek back past skipped bytes")
+        end = self._kept_offset + len(self._kept)
+        if offset > end:
+            skip = offset - end
+            while skip > 0:
+                chunk = self._stream.read(min(skip, SPOOL_CHUNK_SIZE))
+                if not chunk:
+                    break
+                skip -= len(chunk)
+            self._kept = bytearray()
+            self._kept_offset = offset - skip
+            offset = self._kept_offset
+        self._pos = offset
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        if self._owns_stream and not self.closed:
+            self._stream.close()
+        self._kept = bytearray()
+        super(ForwardFile, self).close()
+
+
+def map_file(path, name=None):
+    """Memory-map a whole file, returning a MappedFile."""
+    with open(path, "rb") as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return MappedFile(
+        mapping, 0, len(mapping), name or os.path.basename(path), owns_mapping=True
+    )
+
+
+class DicomInput(object):
+    """
+    An open DICOM input. Use as a context manager so that an archive stays
+    open while its members are being read, possibly from several threads.
+    """
+
+    def __init__(self, source, limits=None):
+        self.source = source
+        self.path = source if isinstance(source, str) else None
+        self.name = source_name(source)
+        self.kind = input_kind(source)
+        self.limits = limits or InputLimits()
+        self._zip = zipfile.ZipFile(source) if self.kind == ZIP else None
+        self._mapping = None
+        self._mapping_lock = threading.Lock()
+        if self._zip is not None:
+            # The central directory tells the size of a zip bomb up front
+            infos = self._zip.infolist()
+            try:
+                self.limits.check_members(len(infos), sum(info.file_size for info in infos))
+            except InputLimitError:
+                # __exit__ never runs for a constructor that raises
+                self._zip.close()
+                raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+        if self._mapping is not None:
+            self._mapping.close()
+
+    def members(self, reverse=False):
+        """
+        Yield a Member for every regular file of the input.
+
+        Zip archives and directories are visited in archive (sorted) order, or
+        the opposite when reverse is set. Tar archives are read as a stream,
+        in archive order only, so a tar member can only be opened until the
+        iteration moves on to the next one. Raises InputLimitError as soon as
+        the members exceed the limits of the input.
+        """
+        if reverse and self.kind not in RANDOM_ACCESS_KINDS:
+            raise ValueError("Cannot visit a %s input in reverse order" % self.kind)
+
+        if self.kind == ZIP:
+            members = self._zip_members(reverse)
+        elif self.kind == TAR:
+            members = self._tar_members()
+        elif self.kind == DIRECTORY:
+            members = self._directory_members(reverse)
+        else:
+            members = self._file_members()
+        return self._limited(members)
+
+    def _limited(self, members):
+        total_size = 0
+        for count, member in enumerate(members, 1):
+            total_size += member.size
+            self.limits.check_time()
+            self.limits.check_members(count, total_size)
+            self.limits.check_member(member)
+            yield member
+
+    def names(self):
+        """
+        The member names of a zip or directory input, in archive order.
+        Raises InputLimitError if the members exceed the limits of the input.
+        """
+        if self.kind == ZIP:
+            # Checked against the limits when the archive was opened
+            return [info.filename for info in self._zip.infolist() if not info.is_dir()]
+        elif self.kind == DIRECTORY:
+            names = self._directory_names()
+            self._check_directory(names)
+            return names
+        raise ValueError("Cannot list the members of a %s input up front" % self.kind)
+
+    def _check_directory(self, names):
+        self.limits.check_members(len(names), 0)
+        if self.limits.max_total_size:
+            total_size = sum(os.path.getsize(os.path.join(self.path, name)) for name in names)
+            self.limits.check_members(len(names), total_size)
+
+    def member(self, name):
+        """
+        Return the member called name of a zip or directory input. Raises
+        InputLimitError if it exceeds the limits of the input.
+        """
+        if self.kind == ZIP:
+            member = self._zip_member(self._zip.getinfo(name))
+        elif self.kind == DIRECTORY:
+            member = _file_member(os.path.join(self.path, name), name)
+        else:
+            raise ValueError("Cannot look up members of a %s input by name" % self.kind)
+        self.limits.check_time()
+        self.limits.check_member(member)
+        return member
+
+    def _zip_member(self, info):
+        mapper = None
+        # Members stored without compression (or encryption) are read in
+        # place from a memory map of the archive file
+        if (
+            self.path is not None
+            and info.compress_type == zipfile.ZIP_STORED
+            and not info.flag_bits & 0x1
+        ):
+            mapper = _opener(self._map_zip_member, info)
+        return Member(info.filename, info.file_size, _opener(self._open_zip_member, info), mapper)
+
+    def _open_zip_member(self, info):
+        # Seeking within a compressed zip member inflates it again from the
+        # start, and seeking forwards inflates what is skipped in 16 MiB reads
+        return ForwardFile(self._zip.open(info), info.file_size, info.filename, owns_stream=True)
+
+    def _map_zip_member(self, info):
+        with self._mapping_lock:
+            if self._mapping is None:
+                with open(self.path, "rb") as f:
+                    self._mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # The member data follows its local file header, whose name and
+        # extra field lengths may differ from the central directory.
+        header = self._mapping[info.header_offset:info.header_offset + 30]
+        if header[:4] != b"PK\x03\x04":
+            raise zipfile.BadZipFile("Bad local file header for %s" % info.filename)
+        name_length, extra_length = struct.unpack("<HH", header[26:30])
+        offset = info.header_offset + 30 + name_length + extra_length
+        return MappedFile(self._mapping, offset, info.file_size, info.filename)
+
+    def _zip_members(self, reverse=False):
+        infos = [info for info in self._zip.infolist() if not info.is_dir()]
+        if reverse:
+            infos.reverse()
+        for info in infos:
+            yield self._zip_member(info)
+
+    def _tar_members(self):
+        # Stream mode ('r|*') decompresses sequentially and never seeks back,
+        # so a compressed tar is decompressed once, member by member.
+        if self.path is not None:
+            tf = tarfile.open(self.path, mode="r|*")
+        else:
+            self.source.seek(0)
+            tf = tarfile.open(fileobj=self.source, mode="r|*")
+        with tf:
+            for info in tf:
+                if not info.isfile():
+                    continue
+                fileobj = tf.extractfile(info)
+                # pydicom needs to seek within a member, which a tar stream
+                # only allows forwards.
+                yield Member(info.name, info.size, _opener(ForwardFile, fileobj, info.size, info.name))
+
+    def _directory_members(self, reverse=False):
+        # Only the file names are listed up front; files are opened on demand.
+        names = self._directory_names()
+        if reverse:
+            names.reverse()
+        for name in names:
+            yield self.member(name)
+
+    def _directory_names(self):
+        names = []
+        for root, dirs, files in os.walk(self.path):
+            dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                if not name.startswith(".") and os.path.isfile(file_path):
+                    names.append(os.path.relpath(file_path, self.path))
+        return names
+
+    def _file_members(self):
+        if self.path is not None:
+            yield _file_member(self.path, self.name)
+            return
+        self.source.seek(0, io.SEEK_END)
+        size = self.source.tell()
+        yield Member(self.name, size, _opener(_read_source, self.source, size))
+
+
+def open_input(source, limits=None):
+    """Open the DICOM input at source, a path or a binary file object."""
+    return DicomInput(source, limits)
+
+
+def iter_members(source, reverse=False, limits=None):
+    """Yield a Member for every regular file of the input at source."""
+    with open_input(source, limits) as dicom:
+        for member in dicom.members(reverse=reverse):
+            yield member
+
+
+def _file_member(file_path, name):
+    size = os.path.getsize(file_path)
+    # Empty files cannot be memory-mapped
+    mapper = _opener(map_file, file_path, name) if size else None
+    return Member(name, size, _opener(open, file_path, "rb"), mapper)
+
+
+def _opener(func, *args):
+    return lambda: func(*args)
+
+
+def _read_source(fileobj, size):
+    # A view that can be closed without closing the caller's file object
+    fileobj.seek(0)
+    return ForwardFile(fileobj, size, source_name(fileobj))
+
+
+def is_raw_data(dcm):
+    """Return True if dcm is a Raw Data Storage instance."""
+    sop_class = dcm.get("SOPClassUID")
+    return sop_class == RAW_DATA_STORAGE or getattr(sop_class, "name", None) == "Raw Data Storage"
+
+
+def has_pixel_data(dcm):
+    """Return True if dcm has pixel data, even if it was not read."""
+    return "PixelData" in dcm or getattr(dcm, "pixel_data_skipped", False)
+
+
+def _at_pixel_data(tag, VR, length):
+    return tag == 0x7FE00010
+
+
+def _element_budget(max_elements, stop_when=None):
+    # A stop_when callback for pydicom counting the elements read, which
+    # fails once there are more than max_elements, e.g. when force makes
+    # pydicom read garbage as elements
+    count = [0]
+
+    def check(tag, VR, length):
+        if stop_when is not None and stop_when(tag, VR, length):
+            return True
+        count[0] += 1
+        if max_elements and count[0] > max_elements:
+            raise InputLimitError("A header has more than %d elements" % max_elements)
+        return False
+
+    return check
+
+
+def dcmread(fileobj, force=False, stop_before_pixels=False, specific_tags=None, max_elements=None):
+    """pydicom.dcmread of a file object, with at most max_elements top level elements."""
+    stop_when = _at_pixel_data if stop_before_pixels else None
+    if max_elements:
+        stop_when = _element_budget(max_elements, stop_when)
+    return pydicom.filereader.read_partial(
+        fileobj, stop_when, force=force, specific_tags=specific_tags
+    )
+
+
+def read_header_and_trailer(fileobj, force=False, max_elements=None):
+    """
+    Read a member without its pixel data: the header up to the pixel data
+    and whatever elements follow it. The dataset records whether pixel data
+    was skipped in pixel_data_skipped. Returns None for deflated files,
+    which have to be inflated in full.
+    """
+    stop_when = _element_budget(max_elements, _at_pixel_data)
+    dcm = pydicom.filereader.read_partial(fileobj, stop_when, force=force)
+    file_meta = getattr(dcm, "file_meta", None)
+    if file_meta and file_meta.get("TransferSyntaxUID") == DEFLATED_TRANSFER_SYNTAX:
+        return None
+    # pydicom leaves the file positioned on the tag it stopped at. Step over
+    # the pixel data and read whatever elements follow it.
+    dcm.pixel_data_skipped = fileobj.read(4) in PIXEL_DATA_TAGS
+    if dcm.pixel_data_skipped:
+        _skip_pixel_data_value(fileobj, dcm.is_implicit_VR, dcm.is_little_endian)
+        trailing = pydicom.filereader.read_dataset(
+            fileobj, dcm.is_implicit_VR, dcm.is_little_endian, stop_when=stop_when
+        )
+        for tag in trailing.keys():
+            dcm[tag] = trailing.get_item(tag)
+    return dcm
+
+
+def _skip_pixel_data_value(fileobj, is_implicit_VR, is_little_endian):
+    # Positioned right after the Pixel Data tag: read the length and seek past
+    # the value, walking the item headers of encapsulated pixel data.
+    endian = "<" if is_little_endian else ">"
+    if not is_implicit_VR:
+        fileobj.read(4)  # VR and reserved bytes
+    (length,) = struct.unpack(endian + "L", fileobj.read(4))
+    if length != 0xFFFFFFFF:
+        fileobj.seek(length, io.SEEK_CUR)
+        return
+    while True:
+        item = fileobj.read(8)
+        if len(item) < 8:
+            return
+        group, element, item_length = struct.unpack(endian + "HHL", item)
+        if (group, element) == (0xFFFE, 0xE0DD):  # Sequence Delimitation Item
+            return
+        fileobj.seek(item_length, io.SEEK_CUR)
+
+
+def read_member(member, force=False, max_elements=None):
+    """
+    Read a member with pydicom, skipping its pixel data. Returns None if it
+    cannot be parsed, raises InputLimitError if its header has more than
+    max_elements elements.
+    """
+    try:
+        log.info("reading %s" % member.name)
+        open_member = member.map if member.map is not None else member.open
+        with open_member() as fileobj:
+            dcm = read_header_and_trailer(fileobj, force=force, max_elements=max_elements)
+            if dcm is None:
+                fileobj.seek(0)
+                dcm = dcmread(fileobj, force=force, max_elements=max_elements)
+        return dcm
+    except InputLimitError:
+        raise
+    except Exception:
+        log.debug("Could not read %s as DICOM" % member.name)
+        return None
+
+
+def map_members(func, members, workers=None, read_ahead=None):
+    """
+    Yield func(member) for every member, in order, computed by a pool of
+    worker threads. At most read_ahead members (twice the workers by
+    default) are in flight, so memory stays flat however many members there
+    are. Members not started yet are dropped if the iteration stops early.
+    """
+    workers = workers or DEFAULT_WORKERS
+    read_ahead = read_ahead or 2 * workers
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        try:
+            for member in members:
+                pending.append(executor.submit(func, member))
+                if len(pending) >= read_ahead:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def read_representative(source, force=False, workers=None, limits=None):
+    """
+    Read the DICOM file used to classify the input at source.
+
+    This is the last member of the input that is not Raw Data Storage. If
+    all members are Raw Data Storage, we accept our fate and use the first
+    one that can be read. Returns None if no member can be read, raises
+    InputLimitError if the input exceeds limits.
+    """
+    limits = limits or InputLimits()
+    max_elements = limits.max_header_elements
+    if input_kind(source) in RANDOM_ACCESS_KINDS:
+        dcm = None
+        with open_input(source, limits) as dicom:
+            records = read_dicomdir(dicom, force=force)
+            if records:
+                dcm = _read_indexed_representative(dicom, records, force, max_elements)
+                if dcm is not None:
+                    return dcm
+
+            # Walk backwards and stop at the first suitable member, reading the
+            # member before it meanwhile in case it turns out to be Raw Data Storage
+            datasets = map_members(
+                lambda member: read_member(member, force=force, max_elements=max_elements),
+                dicom.members(reverse=True),
+                workers,
+                read_ahead=2,
+            )
+            for member_dcm in datasets:
+                if member_dcm is None:
+                    continue
+                dcm = member_dcm
+                if not is_raw_data(dcm):
+                    break
+            datasets.close()
+        return dcm
+
+    # Streams can only be walked forwards, so every member has to be read.
+    fallback = None
+    dcm = None
+    for member in iter_members(source, limits=limits):
+        member_dcm = read_member(member, force=force, max_elements=max_elements)
+        if member_dcm is None:
+            continue
+        if fallback is None:
+            fallback = member_dcm
+        if not is_raw_data(member_dcm):
+            dcm = member_dcm
+    return dcm if dcm is not None else fallback
+
+
+def _read_indexed_representative(dicom, records, force, max_elements):
+    # The last image the DICOMDIR lists that is not Raw Data Storage
+    for record in reversed(records):
+        if record.record_type != IMAGE_RECORD or record.sop_class_uid == RAW_DATA_STORAGE:
+            continue
+        dcm = read_member(dicom.member(record.name), force=force, max_elements=max_elements)
+        if dcm is not None and not is_raw_data(dcm):
+            return dcm
+    return None
+
+
+def read_dicomdir(dicom, force=False):
+    """
+    Read the DICOMDIR of an open zip or directory input, if it has one.
+
+    Returns a DicomdirRecord for every instance record referencing a member
+    of the input, in archive order, or None if the input has no DICOMDIR or
+    its DICOMDIR references none of its members.
+    """
+    if dicom.kind not in RANDOM_ACCESS_KINDS:
+        return None
+    names = dicom.names()
+    # File IDs are relative to the DICOMDIR, and often upper case on media
+    paths = [name.replace(os.sep, "/") for name in names]
+    dicomdir_paths = [
+        (path.count("/"), n) for n, path in enumerate(paths)
+        if posixpath.basename(path).upper() == DICOMDIR_NAME
+    ]
+    if not dicomdir_paths:
+        return None
+    dicomdir_name = names[min(dicomdir_paths)[1]]
+    try:
+        with dicom.member(dicomdir_name).open() as fileobj:
+            patients = pydicom.dcmread(fileobj, force=force).patient_records
+    except InputLimitError:
+        raise
+    except Exception:
+        log.debug("Could not read %s as a DICOMDIR" % dicomdir_name)
+        return None
+
+    base = posixpath.dirname(dicomdir_name.replace(os.sep, "/"))
+    positions = dict((path.upper(), n) for n, path in enumerate(paths))
+    records = []
+    for patient in patients:
+        for study in patient.children:
+            for series in study.children:
+                for instance in series.children:
+                    file_id = instance.get("ReferencedFileID")
+                    if not file_id:
+                        continue
+                    if isinstance(file_id, str):
+                        file_id = [file_id]
+                    position = positions.get(posixpath.join(base, *file_id).upper())
+                    if position is None:
+                        continue
+                    record = DicomdirRecord(
+                        names[position],
+                        series.get("SeriesInstanceUID"),
+                        instance.get("ReferencedSOPClassUIDInFile"),
+                        instance.get("DirectoryRecordType"),
+                    )
+                    records.append((position, record))
+    if not records:
+        return None
+    records.sort(key=lambda item: item[0])
+    log.info("Found %d members of %s in %s" % (len(records), dicom.name, dicomdir_name))
+    return [record for _, record in records]
+
+
+def read_header(member, force=False, specific_tags=None, max_elements=None):
+    """
+    Read the header of a member, stopping before the pixel data. Returns
+    None if the member cannot be parsed, raises InputLimitError if it has
+    more than max_elements elements.
+    """
+    try:
+        open_member = member.map if member.map is not None else member.open
+        with open_member() as fileobj:
+            return dcmread(
+                fileobj,
+                force=force,
+                stop_before_pixels=True,
+                specific_tags=specific_tags,
+                max_elements=max_elements,
+            )
+    except InputLimitError:
+        raise
+    except Exception:
+        log.debug("Could not read the header of %s" % member.name)
+        return None
+
+
+def group_series(dicom, force=False, workers=None, tags=None):
+    """
+    Group the members of an open input by SeriesInstanceUID.
+
+    Inputs with a DICOMDIR are grouped from its records, without opening
+    any other member. Otherwise only the headers are read, by a pool of
+    worker threads with a bounded read-ahead when the input allows random
+    access. Returns an OrderedDict mapping each series UID to the list of
+    (member name, skip) of its members, in archive order, where skip is
+    set for Raw Data Storage members and non-image DICOMDIR records.
+
+    With tags, those header tags of every member are read in the same pass
+    and (series, headers) returned, headers mapping each series UID to the
+    headers of its members.
+    """
+    series = collections.OrderedDict()
+    headers = None if tags is None else collections.OrderedDict()
+    records = read_dicomdir(dicom, force=force)
+    if records:
+        for record in records:
+            # Only images are representatives, as in _read_indexed_representative
+            skip = record.record_type != IMAGE_RECORD or record.sop_class_uid == RAW_DATA_STORAGE
+            series.setdefault(record.series_uid, []).append((record.name, skip))
+        log.info("Found %d series in the DICOMDIR of %s" % (len(series), dicom.name))
+        if headers is None:
+            return series
+        members = (dicom.member(record.name) for record in records)
+        for _, header in _read_headers(dicom, members, list(tags) + ["SeriesInstanceUID"], force, workers):
+            if header is not None:
+                headers.setdefault(header.get("SeriesInstanceUID"), []).append(header)
+        return series, headers
+
+    header_tags = ["SeriesInstanceUID", "SOPClassUID"] + list(tags or [])
+    for name, header in _read_headers(dicom, dicom.members(), header_tags, force, workers):
+        if header is None:
+            continue
+        series_uid = header.get("SeriesInstanceUID")
+        series.setdefault(series_uid, []).append((name, is_raw_data(header)))
+        if headers is not None:
+            headers.setdefault(series_uid, []).append(header)
+
+    log.info("Found %d series in %s" % (len(series), dicom.name))
+    return series if headers is None else (series, headers)
+
+
+def _read_headers(dicom, members, tags, force, workers):
+    # (name, header) of each member, read by a pool of worker threads when
+    # the input allows random access
+    def member_header(member):
+        header = read_header(
+            member,
+            force=force,
+            specific_tags=tags,
+            max_elements=dicom.limits.max_header_elements,
+        )
+        return member.name, header
+
+    if dicom.kind in RANDOM_ACCESS_KINDS:
+        return map_members(member_header, members, workers)
+    return (member_header(member) for member in members)
+
+
+def pick_representative(series_members):
+    """
+    Pick the member name used to classify a series: the last member not to
+    skip, or the first member if they are all to skip.
+    """
+    for name, skip in reversed(series_members):
+        if not skip:
+            return name
+    return series_members[0][0]
+
+
+def read_members(dicom, names, force=False, workers=None):
+    """Read the named members of an open input, keyed by name."""
+    max_elements = dicom.limits.max_header_elements
+    if dicom.kind in RANDOM_ACCESS_KINDS:
+        datasets = map_members(
+            lambda name: read_member(dicom.member(name), force=force, max_elements=max_elements),
+            names,
+            workers,
+        )
+        return dict(zip(names, datasets))
+
+    wanted = set(names)
+    datasets = {}
+    for member in dicom.members():
+        if member.name in wanted:
+            datasets[member.name] = read_member(member, force=force, max_elements=max_elements)
+    return datasets
+
+
+def read_series_representatives(source, force=False, workers=None, limits=None, tags=None):
+    """
+    Read one representative DICOM file per series of the input at source,
+    in the order the series first appear in the input. Inputs read forward
+    only are read in a single pass. With tags, those header tags of every
+    member are read in the same pass and (representatives, headers)
+    returned, as by group_series. Raises InputLimitError if the input
+    exceeds limits.
+    """
+    with open_input(source, limits) as dicom:
+        if dicom.kind not in RANDOM_ACCESS_KINDS:
+            return _read_forward_representatives(dicom, force, tags)
+        grouped = group_series(dicom, force=force, workers=workers, tags=tags)
+        series, headers = (grouped, None) if tags is None else grouped
+        names = [pick_representative(members) for members in series.values()]
+        datasets = read_members(dicom, names, force=force, workers=workers)
+    dcms = [datasets[name] for name in names if datasets.get(name) is not None]
+    return dcms if tags is None else (dcms, headers)
+
+
+def _read_forward_representatives(dicom, force, tags=None):
+    # As in read_representative, keep the last member of each series that is
+    # not Raw Data Storage, or else its first member
+    fallbacks = collections.OrderedDict()
+    representatives = {}
+    headers = None if tags is None else collections.OrderedDict()
+    for member in dicom.members():
+        dcm = read_member(member, force=force, max_elements=dicom.limits.max_header_elements)
+        if dcm is None:
+            continue
+        series_uid = dcm.get("SeriesInstanceUID")
+        fallbacks.setdefault(series_uid, dcm)
+        if not is_raw_data(dcm):
+            representatives[series_uid] = dcm
+        if headers is not None:
+            # Only the tags are kept, not the whole header of every member
+            headers.setdefault(series_uid, []).append(_select_tags(dcm, tags))
+    log.info("Found %d series in %s" % (len(fallbacks), dicom.name))
+    dcms = [representatives.get(series_uid, dcm) for series_uid, dcm in fallbacks.items()]
+    return dcms if tags is None else (dcms, headers)
+
+
+def _select_tags(dcm, tags):
+    header = pydicom.Dataset()
+    for tag in map(pydicom.tag.Tag, list(tags) + ["SeriesInstanceUID"]):
+        if tag in dcm:
+            header.add(dcm[tag])
+    return header
+
+
+def read_series_headers(source, tags, force=False, workers=None, limits=None):
+    """
+    Read the given header tags of every member of the input at source,
+    stopping before the pixel data. Returns an OrderedDict mapping each
+    SeriesInstanceUID to the headers of its members, in archive order.
+    Raises InputLimitError if the input exceeds limits.
+    """
+    with open_input(source, limits) as dicom:
+        tags = list(tags) + ["SeriesInstanceUID"]
+        series = collections.OrderedDict()
+        for _, header in _read_headers(dicom, dicom.members(), tags, force, workers):
+            if header is not None:
+                series.setdefault(header.get("SeriesInstanceUID"), []).append(header)
+    return series
+
+
+def spool(stream, max_size):
+    """
+    Copy a binary stream into a seekable file object: in memory while it is
+    up to max_size bytes, spilled to an anonymous temporary file beyond.
+    """
+    buffer = io.BytesIO()
+    while True:
+        chunk = stream.read(SPOOL_CHUNK_SIZE)
+        if not chunk:
+            break
+        buffer.write(chunk)
+        if buffer.tell() > max_size:
+            log.debug("Spooled more than %d bytes, spilling to disk" % max_size)
+            spilled = tempfile.TemporaryFile()
+            spilled.write(buffer.getbuffer())
+            buffer = None
+            shutil.copyfileobj(stream, spilled, SPOOL_CHUNK_SIZE)
+            spilled.seek(0)
+            return spilled
+    buffer.seek(0)
+    return buffer
@@ -0,0 +1,1053 @@
+#!/usr/bin/env python
+"""
+Generate session, subject, and acquisition metadata by parsing the dicom
+header of an input, using pydicom, and classify it.
+
+    import dicom_mr_classifier
+    metadata = dicom_mr_classifier.classify_input("/path/to/dicom.zip")
+"""
+
+import io
+import os
+import re
+import json
+import pytz
+import pydicom
+import pydicom.datadict
+import functools
+import tzlocal
+import logging
+import datetime
+import dicom_input
+import concurrent.futures
+import classification_from_label
+import classification_from_parameters
+import slice_geometry
+from fnmatch import fnmatch, translate
+from value_conversion import assign_type, format_string
+
+log = logging.getLogger("dicom-mr-classifier")
+
+DEFAULT_TIME = '120000.00'
+
+# Header values shared by the acquisitions of a session, next to their metadata
+SESSION_INFO_FILE = ".session_info.json"
+
+
+class ClassificationError(Exception):
+    """Raised when an input cannot be read or classified."""
+
+
+class ResourceLimitError(ClassificationError):
+    """Raised when an input exceeds its resource limits."""
+
+
+def get_session_label(dcm):
+    """
+    Switch on manufacturer and either pull out the StudyID or the StudyInstanceUID
+    """
+    session_label = ""
+    if (
+        dcm.get("Manufacturer")
+        and (
+            dcm.get("Manufacturer").find("GE") != -1
+            or dcm.get("Manufacturer").find("Philips") != -1
+        )
+        and dcm.get("StudyID")
+    ):
+        session_label = dcm.get("StudyID")
+    else:
+        session_label = dcm.get("StudyInstanceUID")
+
+    return session_label
+
+
+def validate_timezone(zone):
+    # pylint: disable=missing-docstring
+    if zone is None:
+        zone = tzlocal.get_localzone()
+    else:
+        try:
+            zone = pytz.timezone(zone.zone)
+        except pytz.UnknownTimeZoneError:
+            zone = None
+    return zone
+
+
+def parse_patient_age(age):
+    """
+    Parse patient age from string.
+    convert from 70d, 10w, 2m, 1y to datetime.timedelta object.
+    Returns age as duration in seconds.
+    """
+    if age == "None" or not age:
+        return None
+
+    conversion = {  # conversion to days
+        "Y": 365.25,
+        "M": 30,
+        "W": 7,
+        "D": 1,
+    }
+    scale = age[-1:]
+    value = age[:-1]
+    if scale not in conversion.keys():
+        # Assume years
+        scale = "Y"
+        value = age
+
+    age_in_seconds = datetime.timedelta(
+        int(value) * conversion.get(scale)
+    ).total_seconds()
+
+    # Make sure that the age is reasonable
+    if not age_in_seconds or age_in_seconds <= 0:
+        age_in_seconds = None
+
+    return age_in_seconds
+
+
+def timestamp(date, time, timezone):
+    """
+    Return datetime formatted string
+    """
+    if date and time and timezone:
+        # return datetime.datetime.strptime(date + time[:6], '%Y%m%d%H%M%S')
+        try:
+            return timezone.localize(
+                datetime.datetime.strptime(date + time[:6], "%Y%m%d%H%M%S"), timezone
+            )
+        except Exception:
+            log.warning("Failed to create timestamp!")
+            log.info(date)
+            log.info(time)
+            log.info(timezone)
+            return None
+    return None
+
+
+def get_timestamp(dcm, timezone):
+    """
+    Parse Study Date and Time, return acquisition and session timestamps.
+
+    For study date/time Dicom tag used by order of priority goes like a:
+        - StudyDate/StudyTime
+        - SeriesDate/SeriesTime
+        - AcquisitionDate/AcquisitionTime
+        - AcquisitionDateTime
+        - StudyDate and Time defaults to DEFAULT_TIME
+        - SeriesDates and Time defaults to DEFAULT_TIME
+        - AcquisitionDate and Time defaults to DEFAULT_TIME
+
+    For acquisition date/time Dicom tag used by order of priority goes like a:
+        - SeriesDate/SeriesTime
+        - AcquisitionDate/AcquisitionTime
+        - AcquisitionDateTime
+        - ContentDate/ContentTime
+        - StudyDate/StudyTime
+        - SeriesDate and Time defaults to DEFAULT_TIME
+        - AcquisitionDate and Time defaults to DEFAULT_TIME
+        - StudyDate and Time defaults to DEFAULT_TIME
+    """
+    # Study Date and Time, with precedence as below
+    if getattr(dcm, 'StudyDate', None) and getattr(dcm, 'StudyTime', None):
+        study_date = dcm.StudyDate
+        study_time = dcm.StudyTime
+    elif getattr(dcm, 'SeriesDate', None) and getattr(dcm, 'SeriesTime', None):
+        study_date = dcm.SeriesDate
+        study_time = dcm.SeriesTime
+    elif getattr(dcm, 'AcquisitionDate', None) and getattr(dcm, 'AcquisitionTime', None):
+        study_date = dcm.AcquisitionDate
+        study_time = dcm.AcquisitionTime
+    elif getattr(dcm, 'AcquisitionDateTime', None):
+        study_date = dcm.AcquisitionDateTime[0:8]
+        study_time = dcm.AcquisitionDateTime[8:]
+    elif getattr(dcm, 'StudyTime', None) and getattr(dcm, 'InstanceCreationDate', None):
+        study_date = dcm.InstanceCreationDate
+        study_time = dcm.StudyTime
+    # If only Dates are available setting time to 00:00
+    elif getattr(dcm, 'StudyDate', None):
+        study_date = dcm.StudyDate
+        study_time = DEFAULT_TIME
+    elif getattr(dcm, 'SeriesDate', None):
+        study_date = dcm.SeriesDate
+        study_time = DEFAULT_TIME
+    elif getattr(dcm, 'AcquisitionDate', None):
+        study_date = dcm.AcquisitionDate
+        study_time = DEFAULT_TIME
+    elif getattr(dcm, 'InstanceCreationDate', None):
+        study_date = dcm.InstanceCreationDate
+        study_time = DEFAULT_TIME
+    else:
+        study_date = None
+        study_time = None
+
+    # Acquisition Date and Time, with precedence as below
+    if getattr(dcm, 'SeriesDate', None) and getattr(dcm, 'SeriesTime', None):
+        acquisition_date = dcm.SeriesDate
+        acquisition_time = dcm.SeriesTime
+    elif getattr(dcm, 'AcquisitionDate', None) and getattr(dcm, 'AcquisitionTime', None):
+        acquisition_date = dcm.AcquisitionDate
+        acquisition_time = dcm.AcquisitionTime
+    elif getattr(dcm, 'AcquisitionDateTime', None):
+        acquisition_date = dcm.AcquisitionDateTime[0:8]
+        acquisition_time = dcm.AcquisitionDateTime[8:]
+    # The following allows the timestamps to be set for ScreenSaves
+    elif getattr(dcm, 'ContentDate', None) and getattr(dcm, 'ContentTime', None):
+        acquisition_date = dcm.ContentDate
+        acquisition_time = dcm.ContentTime
+    # Looking deeper if nothing found so far
+    elif getattr(dcm, 'StudyDate', None) and getattr(dcm, 'StudyTime', None):
+        acquisition_date = dcm.StudyDate
+        acquisition_time = dcm.StudyTime
+    elif getattr(dcm, 'InstanceCreationDate', None) and getattr(dcm, 'InstanceCreationTime', None):
+        acquisition_date = dcm.InstanceCreationDate
+        acquisition_time = dcm.InstanceCreationTime
+    # If only Dates are available setting time to 00:00
+    elif getattr(dcm, 'SeriesDate', None):
+        acquisition_date = dcm.SeriesDate
+        acquisition_time = DEFAULT_TIME
+    elif getattr(dcm, 'AcquisitionDate', None):
+        acquisition_date = dcm.AcquisitionDate
+        acquisition_time = DEFAULT_TIME
+    elif getattr(dcm, 'StudyDate', None):
+        acquisition_date = dcm.StudyDate
+        acquisition_time = DEFAULT_TIME
+    elif getattr(dcm, 'InstanceCreationDate', None):
+        acquisition_date = dcm.InstanceCreationDate
+        acquisition_time = DEFAULT_TIME
+
+    else:
+        acquisition_date = None
+        acquisition_time = None
+
+    session_timestamp = timestamp(study_date, study_time, timezone)
+    acquisition_timestamp = timestamp(acquisition_date, acquisition_time, timezone)
+
+    if session_timestamp:
+        if session_timestamp.tzinfo is None:
+            log.info('no tzinfo found, using UTC...')
+            session_timestamp = pytz.timezone('UTC').localize(session_timestamp)
+        session_timestamp = session_timestamp.isoformat()
+    else:
+        session_timestamp = ''
+    if acquisition_timestamp:
+        if acquisition_timestamp.tzinfo is None:
+            log.info('no tzinfo found, using UTC')
+            acquisition_timestamp = pytz.timezone('UTC').localize(acquisition_timestamp)
+        acquisition_timestamp = acquisition_timestamp.isoformat()
+    else:
+        acquisition_timestamp = ''
+    return session_timestamp, acquisition_timestamp
+
+
+def get_sex_string(sex_str):
+    """
+    Return male or female string.
+    """
+    if sex_str == "M":
+        sex = "male"
+    elif sex_str == "F":
+        sex = "female"
+    else:
+        sex = ""
+    return sex
+
+
+def get_seq_data(sequence, ignore_keys):
+    seq_dict = {}
+    for seq in sequence:
+        for s_key in seq.dir():
+            s_val = getattr(seq, s_key, "")
+            if type(s_val) is pydicom.uid.UID or s_key in ignore_keys:
+                continue
+
+            if type(s_val) == pydicom.sequence.Sequence:
+                _seq = get_seq_data(s_val, ignore_keys)
+                seq_dict[s_key] = _seq
+                continue
+
+            if type(s_val) == str:
+                s_val = format_string(s_val)
+            else:
+                s_val = assign_type(s_val, seq.data_element(s_key).VR)
+
+            if s_val:
+                seq_dict[s_key] = s_val
+
+    return seq_dict
+
+
+class HeaderProjection(object):
+    """
+    Allowlist and denylist of the header fields written to the file info.
+
+    Patterns are globs over DICOM keywords (e.g. "Patient*"), tags of
+    standard fields with x wildcards (e.g. "(0018,xxxx)" or "0018xxxx") or,
+    prefixed with "csa:", globs over CSA header tag names (e.g. "csa:B_*").
+    Private fields have no keyword and are never written. Without include
+    patterns a field is kept unless it matches an exclude pattern. With
+    include patterns, it is kept only if it also matches one of the include
+    patterns of its kind: include patterns of DICOM fields alone leave out
+    the whole CSA header, and "csa:" patterns alone every DICOM field.
+    """
+
+    TAG_PATTERN = re.compile(r"^\(?([0-9a-fx]{4}),?([0-9a-fx]{4})\)?$", re.IGNORECASE)
+    CSA_PREFIX = "csa:"
+
+    def __init__(self, include=None, exclude=None):
+        self.include = self._compile(include)
+        self.exclude = self._compile(exclude)
+        self.has_include = any(self.include.values())
+
+    def _compile(self, patterns):
+        # Split the patterns by kind and fold each kind into one regex
+        keywords, tags, csa_names = [], [], []
+        for pattern in patterns or []:
+            if pattern.lower().startswith(self.CSA_PREFIX):
+                csa_names.append(translate(pattern[len(self.CSA_PREFIX):]))
+                continue
+            tag_match = self.TAG_PATTERN.match(pattern)
+            if tag_match:
+                tags.append("".join(tag_match.groups()).upper().replace("X", "."))
+            else:
+                keywords.append(translate(pattern))
+        return {
+            "keyword": re.compile("|".join(keywords)) if keywords else None,
+            "tag": re.compile("^(?:%s)$" % "|".join(tags)) if tags else None,
+            "csa": re.compile("|".join(csa_names)) if csa_names else None,
+        }
+
+    def _matches(self, patterns, keyword):
+        if patterns["keyword"] and patterns["keyword"].match(keyword):
+            return True
+        if patterns["tag"]:
+            tag = pydicom.datadict.tag_for_keyword(keyword)
+            return tag is not None and bool(patterns["tag"].match("%08X" % tag))
+        return False
+
+    def allows(self, keyword):
+        """Return True if the DICOM keyword is to be written."""
+        if self.has_include and not self._matches(self.include, keyword):
+            return False
+        return not self._matches(self.exclude, keyword)
+
+    def allows_csa(self, name):
+        """Return True if the CSA header tag name is to be written."""
+        if self.has_include and not (self.include["csa"] and self.include["csa"].match(name)):
+            return False
+        return not (self.exclude["csa"] and self.exclude["csa"].match(name))
+
+    def allows_any_csa(self):
+        """Return False if every CSA header tag is excluded."""
+        if self.has_include and not self.include["csa"]:
+            return False
+        return not (self.exclude["csa"] and self.exclude["csa"].match(""))
+
+
+def get_header_projection(config=None):
+    """
+    Build the HeaderProjection from the header_include and header_exclude
+    config options, lists or comma separated strings of patterns. Returns
+    None if neither is set.
+    """
+    if not config:
+        return None
+    patterns = []
+    for option in ["header_include", "header_exclude"]:
+        value = config["config"].get(option) or []
+        if isinstance(value, str):
+            value = [v for v in re.split(r"\s*,\s*", value.strip()) if v]
+        patterns.append(value)
+    if not any(patterns):
+        return None
+    return HeaderProjection(*patterns)
+
+
+def get_dicom_header(dcm, projection=None):
+    # Extract the header values
+    header = {}
+    exclude_tags = [
+        "[Unknown]",
+        "PixelData",
+        "Pixel Data",
+        "[User defined data]",
+        "[Protocol Data Block (compressed)]",
+        "[Histogram tables]",
+        "[Unique image iden]",
+    ]
+    tags = dcm.dir()
+    if projection:
+        # Drop the fields that are not wanted before converting any value
+        tags = [tag for tag in tags if projection.allows(tag)]
+    for tag in tags:
+        try:
+            element = dcm.data_element(tag)
+            value = element.value
+            if (tag not in exclude_tags) and (
+                type(value) != pydicom.sequence.Sequence
+            ):
+                if value or value == 0:  # Some values are zero
+                    # Put the value in the header
+                    if (
+                        type(value) == str and len(value) < 10240
+                    ):  # Max dicom field length
+                        header[tag] = format_string(value)
+                    else:
+                        header[tag] = assign_type(value, element.VR)
+                else:
+                    log.debug("No value found for tag: " + tag)
+
+            if type(value) == pydicom.sequence.Sequence:
+                seq_data = get_seq_data(value, exclude_tags)
+                # Check that the sequence is not empty
+                if seq_data:
+                    header[tag] = seq_data
+        except Exception:
+            log.debug("Failed to get " + tag)
+            pass
+    return header
+
+
+def get_csa_header(dcm, projection=None):
+    import pydicom
+    import nibabel.nicom.dicomwrappers
+
+    exclude_tags = ["PhoenixZIP", "SrMsgBuffer"]
+    header = {}
+    try:
+        raw_csa_header = nibabel.nicom.dicomwrappers.SiemensWrapper(dcm).csa_header
+        tags = raw_csa_header["tags"]
+    except Exception:
+        log.warning("Failed to parse csa header!")
+        return header
+
+    for tag in tags:
+        if projection and not projection.allows_csa(tag):
+            continue
+        if not raw_csa_header["tags"][tag]["items"] or tag in exclude_tags:
+            log.debug("Skipping : %s" % tag)
+            pass
+        else:
+            value = raw_csa_header["tags"][tag]["items"]
+            VR = raw_csa_header["tags"][tag]["vr"]
+            if len(value) == 1:
+                value = value[0]
+                if type(value) == str and (len(value) > 0 and len(value) < 1024):
+                    header[format_string(tag)] = format_string(value)
+                else:
+                    header[format_string(tag)] = assign_type(value, VR)
+            else:
+                header[format_string(tag)] = assign_type(value, VR)
+
+    return header
+
+
+def get_classification_from_string(value):
+    result = {}
+
+    parts = re.split(r"\s*,\s*", value)
+    last_key = None
+    for part in parts:
+        key_value = re.split(r"\s*:\s*", part)
+
+        if len(key_value) == 2:
+            last_key = key = key_value[0]
+            value = key_value[1]
+        else:
+            if last_key:
+                key = last_key
+            else:
+                log.warn("Unknown classification format: {0}".format(part))
+                key = "Custom"
+            value = part
+
+        if key not in result:
+            result[key] = []
+
+        result[key].append(value)
+
+    return result
+
+
+def get_custom_classification(label, config=None):
+    if config is None:
+        return None
+
+    # Check custom classifiers
+    classifications = config["inputs"].get("classifications", {}).get("value", {})
+    if not classifications:
+        log.debug("No custom classifications found in config")
+        return None
+
+    if not isinstance(classifications, dict):
+        log.warning("classifications must be an object!")
+        return None
+
+    return match_custom_classification(label, compile_custom_classifications(classifications))
+
+
+def compile_custom_classifications(classifications):
+    """
+    Compile custom classifications, a dict mapping label patterns to
+    classification strings, into a list of (pattern, match, classification
+    string). Patterns between slashes are regular expressions, others are
+    shell-style wildcards, both case insensitive.
+    """
+    compiled = []
+    for k in classifications.keys():
+        val = classifications[k]
+
+        if not isinstance(val, str):
+            log.warn("Expected string value for classification key %s", k)
+            continue
+
+        if len(k) > 2 and k[0] == "/" and k[-1] == "/":
+            # Regex
+            try:
+                compiled.append((k, re.compile(k[1:-1], re.I).search, val))
+            except re.error:
+                log.exception("Invalid regular expression: %s", k)
+        else:
+            compiled.append((k, functools.partial(_match_glob, k.lower()), val))
+    return compiled
+
+
+def _match_glob(pattern, label):
+    return fnmatch(label.lower(), pattern)
+
+
+def match_custom_classification(label, compiled):
+    """The classification of the first compiled custom classification matching label."""
+    for k, match, val in compiled:
+        if match(label):
+            log.debug("Matched custom classification for key: %s", k)
+            return get_classification_from_string(val)
+    return None
+
+
+def _classify_by_parameters(dcm, dicom_file, fallback, batch=None):
+    """
+    Classify dcm from its acquisition parameters, returning fallback if no
+    rule matches. With a classification_from_parameters.Batch, fallback is
+    returned right away and the files entry updated when the batch is
+    classified.
+    """
+    if batch is None:
+        classification = classification_from_parameters.infer_classification(dcm)
+        log.info("Inferred classification from parameters: %s", classification)
+        return classification or fallback
+
+    non_image = not dicom_input.has_pixel_data(dcm)
+
+    def update(classification):
+        log.info("Inferred classification of %s from parameters: %s", dicom_file["name"], classification)
+        if classification:
+            if non_image:
+                classification.update({"Intent": ["Non-Image"]})
+            dicom_file["classification"] = classification
+
+    batch.add(dcm, update)
+    return fallback
+
+
+def get_file_entry(dcm, name, config=None, rules=None, geometry=None, parameter_batch=None):
+    """
+    Build the files entry of a DICOM file: classification and header info.
+    rules, a classification_rules.RuleSet, replaces the built-in label rules
+    and, if it has any, the custom classifications of config. geometry, the
+    slice geometry summary of the series, is added to the info. With a
+    parameter_batch, the classification from acquisition parameters is
+    deferred until the batch is classified.
+    """
+    dicom_file = {}
+    dicom_file["name"] = name
+    if dcm.get('Modality'):
+        dicom_file["modality"] = format_string(dcm.get("Modality"))
+    else:
+        log.warning('No modality found.')
+        dicom_file["modality"] = None
+
+    dicom_file["classification"] = {}
+
+    by_parameters = config and config["config"].get("parameter_classification")
+    # Unrecognized series imaged in three orthogonal planes are localizers
+    localizer = bool(geometry and geometry.get("Localizer"))
+    series_desc = format_string(dcm.get("SeriesDescription", ""))
+    if series_desc:
+        if rules:
+            classification = rules.custom_classification(series_desc, config)
+        else:
+            classification = get_custom_classification(series_desc, config)
+        log.info("Custom classification from config: %s", classification)
+        if not classification and dcm.get("Modality") == "MR":
+            label_rules = rules or classification_from_label
+            classification = label_rules.infer_classification(series_desc)
+            log.info("Inferred classification from label: %s", classification)
+            if not classification and localizer:
+                classification = {'Intent': ['Localizer']}
+                log.info("Inferred classification from slice geometry: %s", classification)
+            if not classification and by_parameters:
+                classification = _classify_by_parameters(
+                    dcm, dicom_file, {'Custom': ['N/A']}, parameter_batch
+                )
+            # GEAR-1084, keep any custom classification already set.
+            if not classification:
+                classification = {'Custom': ['N/A']}
+        dicom_file["classification"] = classification
+    elif localizer and dcm.get("Modality") == "MR":
+        dicom_file["classification"] = {'Intent': ['Localizer']}
+        log.info("Inferred classification from slice geometry: %s", dicom_file["classification"])
+    elif by_parameters and dcm.get("Modality") == "MR":
+        dicom_file["classification"] = _classify_by_parameters(dcm, dicom_file, {}, parameter_batch)
+
+    # If no pixel data present, make classification intent "Non-Image"
+    if not dicom_input.has_pixel_data(dcm):
+        nonimage_intent = {"Intent": ["Non-Image"]}
+        # If classification is a dict, update dict with intent
+        if isinstance(dicom_file["classification"], dict):
+            dicom_file["classification"].update(nonimage_intent)
+        # Else classification is a list, assign dict with intent
+        else:
+            dicom_file["classification"] = nonimage_intent
+
+    # File info from dicom header
+    projection = get_header_projection(config)
+    dicom_file["info"] = get_dicom_header(dcm, projection)
+
+    # Grab CSA header for Siemens data
+    if dcm.get("Manufacturer") == "SIEMENS" and (
+        not projection or projection.allows_any_csa()
+    ):
+        csa_header = get_csa_header(dcm, projection)
+        if csa_header:
+            dicom_file["info"]["CSAHeader"] = csa_header
+
+    if geometry:
+        dicom_file["info"]["SliceGeometry"] = geometry
+
+    if rules:
+        dicom_file["classification_rules"] = rules.version
+
+    return dicom_file
+
+
+def get_input_limits(config=None):
+    """
+    Build the dicom_input.InputLimits of an input from the max_input_mb,
+    max_members, max_member_mb, max_header_elements and timeout config
+    options. Options that are not set or 0 leave their budget unlimited.
+    """
+    options = config["config"] if config else {}
+
+    def megabytes(option):
+        return int(options[option] * 1024 * 1024) if options.get(option) else None
+
+    return dicom_input.InputLimits(
+        max_total_size=megabytes("max_input_mb"),
+        max_members=options.get("max_members") or None,
+        max_member_size=megabytes("max_member_mb"),
+        max_header_elements=options.get("max_header_elements") or None,
+        timeout=options.get("timeout") or None,
+    )
+
+
+def check_time(limits):
+    """Raise ResourceLimitError if the timeout of limits has passed."""
+    if limits is None:
+        return
+    try:
+        limits.check_time()
+    except dicom_input.InputLimitError as e:
+        raise ResourceLimitError(str(e))
+
+
+def read_input(source, config=None, limits=None):
+    """
+    Read the DICOM datasets to classify from a zip, tar, directory or file
+    path, or from a binary file object holding an archive or a DICOM file.
+
+    Returns the representative dataset of the input, or one per series when
+    the split_series config option is set. Raises ClassificationError if no
+    DICOM file can be read, and ResourceLimitError if the input exceeds
+    limits, by default the limits set in config. Pass the same limits to
+    every stage of an input for its timeout to cover them all.
+    """
+    return _read_input(source, config, limits)[0]
+
+
+def read_input_and_geometry(source, config=None, limits=None):
+    """
+    Read the DICOM datasets to classify, as read_input, and summarize the
+    slice geometry of the input, as read_slice_geometry. With both the
+    split_series and slice_geometry config options set, the input is read
+    once for both. Returns (datasets, geometry).
+    """
+    if limits is None:
+        limits = get_input_limits(config)
+    options = config["config"] if config else {}
+    if not (options.get("split_series") and options.get("slice_geometry")):
+        return read_input(source, config, limits), read_slice_geometry(source, config, limits)
+    dcms, series = _read_input(source, config, limits, slice_geometry.GEOMETRY_TAGS)
+    return dcms, _summarize_geometry(series)
+
+
+def _read_input(source, config, limits, geometry_tags=None):
+    # The datasets to classify, and the headers of every member of their
+    # series with geometry_tags, read along with them when splitting series
+    # Parse config for options
+    if config:
+        config_force = config["config"].get("force")
+        if config_force:
+            log.warning("Attempting to force DICOM read. Input DICOM may not be valid.")
+        config_split_series = config["config"].get("split_series")
+    else:
+        config_force = False
+        config_split_series = False
+
+    # Read the last DICOM file of the input, straight from the archive
+    kind = dicom_input.input_kind(source)
+    if kind == dicom_input.FILE:
+        log.info(
+            "Not an archive. Attempting to read %s directly"
+            % dicom_input.source_name(source)
+        )
+    else:
+        log.info("Reading DICOM files from %s input" % kind)
+    if limits is None:
+        limits = get_input_limits(config)
+    series = None
+    try:
+        if config_split_series and geometry_tags:
+            dcms, series = dicom_input.read_series_representatives(
+                source, force=config_force, limits=limits, tags=geometry_tags
+            )
+        elif config_split_series:
+            # Classify one representative per series
+            dcms = dicom_input.read_series_representatives(
+                source, force=config_force, limits=limits
+            )
+        else:
+            dcm = dicom_input.read_representative(source, force=config_force, limits=limits)
+            dcms = [dcm] if dcm else []
+    except dicom_input.InputLimitError as e:
+        raise ResourceLimitError(str(e))
+
+    if not dcms:
+        raise ClassificationError(
+            'DICOM could not be read! Is this a valid DICOM file? To force parsing the file, run again setting "force" configuration option to "true"'
+        )
+    return dcms, series
+
+
+def read_slice_geometry(source, config=None, limits=None):
+    """
+    Summarize the slice geometry of every series of the input at source
+    from the headers of all of its members, when the slice_geometry config
+    option is set. Returns a dict mapping series UIDs to their summary, or
+    None. Raises ResourceLimitError if the input exceeds limits, by default
+    the limits set in config.
+    """
+    if not (config and config["config"].get("slice_geometry")):
+        return None
+    if limits is None:
+        limits = get_input_limits(config)
+    try:
+        series = dicom_input.read_series_headers(
+            source,
+            slice_geometry.GEOMETRY_TAGS,
+            force=config["config"].get("force"),
+            limits=limits,
+        )
+    except dicom_input.InputLimitError as e:
+        raise ResourceLimitError(str(e))
+    return _summarize_geometry(series)
+
+
+def _summarize_geometry(series):
+    return dict(
+        (series_uid, slice_geometry.summarize_headers(headers))
+        for series_uid, headers in series.items()
+    )
+
+
+def classify_datasets(
+    dcms,
+    timezone=None,
+    config=None,
+    name="",
+    rules=None,
+    geometry=None,
+    parameter_batch=None,
+    limits=None,
+):
+    """
+    Build session, subject and acquisition metadata from parsed DICOM
+    datasets, with one files entry per dataset (series) named after name.
+    The first dataset provides the session and acquisition metadata.
+    rules is a classification_rules.ReloadingRules or RuleSet, whose
+    version is recorded in each files entry. geometry maps series UIDs to
+    their slice geometry summary, as returned by read_slice_geometry.
+    With a classification_from_parameters.Batch, the files entries are
+    classified from acquisition parameters when the batch is classified.
+    Raises ResourceLimitError once the timeout of limits has passed.
+    """
+    if not dcms:
+        raise ClassificationError("No DICOM dataset to classify")
+    if timezone is None:
+        timezone = validate_timezone(None)
+    dcm = dcms[0]
+    # The same rule set classifies every files entry, even if the rules
+    # are reloaded meanwhile
+    rules = getattr(rules, "current", rules)
+
+    # Build metadata
+    metadata = {}
+
+    # Session metadata
+    metadata["session"] = {}
+    session_timestamp, acquisition_timestamp = get_timestamp(dcm, timezone)
+    if session_timestamp:
+        metadata["session"]["timestamp"] = session_timestamp
+    if hasattr(dcm, "OperatorsName") and dcm.get("OperatorsName"):
+        metadata["session"]["operator"] = format_string(dcm.get("OperatorsName"))
+    session_label = get_session_label(dcm)
+    if session_label:
+        metadata["session"]["label"] = session_label
+
+    if hasattr(dcm, "PatientWeight") and dcm.get("PatientWeight"):
+        weight = assign_type(dcm.get("PatientWeight"))
+        try:
+            weight = float(weight)
+            metadata["session"]["weight"] = weight
+        except Exception:
+            log.warning('Could not parse PatientWeight, droppping.')
+            pass
+
+    # Subject Metadata
+    metadata["session"]["subject"] = {}
+    if hasattr(dcm, "PatientSex") and get_sex_string(dcm.get("PatientSex")):
+        metadata["session"]["subject"]["sex"] = get_sex_string(dcm.get("PatientSex"))
+    if hasattr(dcm, "PatientAge") and dcm.get("PatientAge"):
+        try:
+            age = parse_patient_age(dcm.get("PatientAge"))
+            if age:
+                age = int(age)
+                metadata["session"]["age"] = age
+        except Exception:
+            log.warning('Could not parse PatientAge, droppping.')
+            pass
+    if hasattr(dcm, "PatientName") and isinstance(dcm.get('PatientName'),pydicom.valuerep.PersonName):
+        if dcm.get("PatientName").given_name:
+            # If the first name or last name field has a space-separated string, and one or the other field is not
+            # present, then we assume that the operator put both first and last names in that one field. We then
+            # parse that field to populate first and last name.
+            metadata["session"]["subject"]["firstname"] = str(
+                format_string(dcm.get("PatientName").given_name)
+            )
+            if not dcm.get("PatientName").family_name:
+                name = format_string(dcm.get("PatientName").given_name.split(" "))
+                if len(name) == 2:
+                    first = name[0]
+                    last = name[1]
+                    metadata["session"]["subject"]["lastname"] = str(last)
+                    metadata["session"]["subject"]["firstname"] = str(first)
+        if dcm.get("PatientName").family_name:
+            metadata["session"]["subject"]["lastname"] = str(
+                format_string(dcm.get("PatientName").family_name)
+            )
+            if not dcm.get("PatientName").given_name:
+                name = format_string(dcm.get("PatientName").family_name.split(" "))
+                if len(name) == 2:
+                    first = name[0]
+                    last = name[1]
+                    metadata["session"]["subject"]["lastname"] = str(last)
+                    metadata["session"]["subject"]["firstname"] = str(first)
+
+    # Acquisition metadata
+    metadata["acquisition"] = {}
+    if acquisition_timestamp:
+        metadata["acquisition"]["timestamp"] = acquisition_timestamp
+
+    if hasattr(dcm, "Modality") and dcm.get("Modality"):
+        metadata["acquisition"]["instrument"] = format_string(dcm.get("Modality"))
+
+    series_desc = format_string(dcm.get("SeriesDescription", ""))
+    if series_desc:
+        metadata["acquisition"]["label"] = series_desc
+
+    # File classification, one files entry per series
+    geometry = geometry or {}
+
+    def file_entry(series_dcm, entry_name):
+        check_time(limits)
+        series_geometry = geometry.get(series_dcm.get("SeriesInstanceUID"))
+        entry = get_file_entry(series_dcm, entry_name, config, rules, series_geometry, parameter_batch)
+        # The header and CSA header conversions count against the timeout too
+        check_time(limits)
+        return entry
+
+    if len(dcms) > 1:
+        names = [
+            "%s_%s" % (series_dcm.get("SeriesInstanceUID", n), name)
+            for n, series_dcm in enumerate(dcms)
+        ]
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            files = list(executor.map(lambda args: file_entry(*args), zip(dcms, names)))
+    else:
+        files = [file_entry(dcm, name)]
+    metadata["acquisition"]["files"] = files
+
+    return metadata
+
+
+def classify_dataset(dcm, timezone=None, config=None, name="", rules=None):
+    """
+    Classify a parsed DICOM dataset, returning its metadata. Nothing is
+    written to disk.
+    """
+    return classify_datasets([dcm], timezone=timezone, config=config, name=name, rules=rules)
+
+
+def classify_input(source, timezone=None, config=None, name=None, rules=None, parameter_batch=None):
+    """
+    Classify a zip, tar, directory or file path, or a binary file object,
+    returning its metadata. The files entry is named after the input unless
+    name is given. Nothing is written to disk. With a parameter_batch, the
+    classification from acquisition parameters is only filled in once the
+    batch is classified. The limits set in config bound all of it.
+    """
+    limits = get_input_limits(config)
+    dcms, geometry = read_input_and_geometry(source, config, limits)
+    if name is None:
+        name = dicom_input.source_name(source)
+    return classify_datasets(
+        dcms,
+        timezone=timezone,
+        config=config,
+        name=name,
+        rules=rules,
+        geometry=geometry,
+        parameter_batch=parameter_batch,
+        limits=limits,
+    )
+
+
+def classify_bytes(buf, timezone=None, config=None, name="", rules=None):
+    """
+    Classify an archive or DICOM file held in memory, returning its
+    metadata. Nothing is written to disk.
+    """
+    return classify_input(io.BytesIO(buf), timezone=timezone, config=config, name=name, rules=rules)
+
+
+def get_session_key(metadata):
+    """
+    The session an acquisition metadata belongs to: the StudyInstanceUID of
+    its files, or else the session label.
+    """
+    for dicom_file in metadata.get("acquisition", {}).get("files", []):
+        uid = dicom_file.get("info", {}).get("StudyInstanceUID")
+        if uid:
+            return str(uid)
+    return metadata.get("session", {}).get("label", "")
+
+
+def factor_session_info(metadatas):
+    """
+    Factor the header values shared by the files of all acquisition metadata
+    of one session out of their info. Returns the shared info and copies of
+    the metadata whose file info holds only the values differing from it;
+    expand_session_info reverses this.
+    """
+    infos = [
+        dicom_file["info"]
+        for metadata in metadatas
+        for dicom_file in metadata.get("acquisition", {}).get("files", [])
+        if "info" in dicom_file
+    ]
+    shared = _shared_values(infos) if infos else {}
+
+    factored = []
+    for metadata in metadatas:
+        metadata = dict(metadata)
+        if "acquisition" in metadata:
+            acquisition = dict(metadata["acquisition"])
+            acquisition["files"] = [
+                dict(dicom_file, info=_without_shared(dicom_file["info"], shared))
+                if "info" in dicom_file
+                else dicom_file
+                for dicom_file in acquisition.get("files", [])
+            ]
+            metadata["acquisition"] = acquisition
+        factored.append(metadata)
+    return shared, factored
+
+
+def expand_session_info(shared, metadata):
+    """
+    Reconstruct the full file info of metadata factored by
+    factor_session_info, given the shared info of its session.
+    """
+    metadata = dict(metadata)
+    if "acquisition" in metadata:
+        acquisition = dict(metadata["acquisition"])
+        acquisition["files"] = [
+            dict(dicom_file, info=_with_shared(dicom_file["info"], shared))
+            if "info" in dicom_file
+            else dicom_file
+            for dicom_file in acquisition.get("files", [])
+        ]
+        metadata["acquisition"] = acquisition
+    return metadata
+
+
+def load_factored_metadata(path):
+    """
+    Load an acquisition metadata file written in batch mode, with its file
+    info expanded from the SESSION_INFO_FILE of the same directory.
+    """
+    with open(path) as f:
+        metadata = json.load(f)
+    session_info_path = os.path.join(os.path.dirname(path), SESSION_INFO_FILE)
+    with open(session_info_path) as f:
+        shared = json.load(f)
+    return expand_session_info(shared, metadata)
+
+
+def _shared_values(dicts):
+    # Values equal in all dicts; nested dicts (e.g. CSAHeader) are factored key by key
+    shared = {}
+    for key, value in dicts[0].items():
+        if not all(key in d for d in dicts[1:]):
+            continue
+        values = [d[key] for d in dicts]
+        if all(isinstance(v, dict) for v in values):
+            nested = _shared_values(values)
+            if nested:
+                shared[key] = nested
+        elif all(v == value for v in values[1:]):
+            shared[key] = value
+    return shared
+
+
+def _without_shared(info, shared):
+    own = {}
+    for key, value in info.items():
+        if key not in shared:
+            own[key] = value
+        elif isinstance(value, dict):
+            nested = _without_shared(value, shared[key])
+            if nested:
+                own[key] = nested
+    return own
+
+
+def _with_shared(info, shared):
+    full = dict(shared)
+    for key, value in info.items():
+        if key in shared and isinstance(value, dict):
+            full[key] = _with_shared(value, shared[key])
+        else:
+            full[key] = value
+    return full
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+'''
+Measure the memory of the stages of a run: the peak of the Python
+allocations traced by tracemalloc, and the resident set size (RSS) of the
+process before and after each stage.
+
+    tracker = memory_usage.MemoryTracker()
+    with tracker.stage("read"):
+        ...
+    tracker.log_report()
+'''
+
+import os
+import logging
+import contextlib
+import tracemalloc
+import collections
+
+log = logging.getLogger("dicom-mr-classifier")
+
+MIB = 1024.0 * 1024.0
+
+# name: name of the stage
+# traced_peak: peak of the Python allocations made during the stage, in bytes
+# rss_before, rss_after: RSS of the process when the stage started and
+# ended, in bytes, or None where it cannot be read
+Stage = collections.namedtuple("Stage", ["name", "traced_peak", "rss_before", "rss_after"])
+
+
+def current_rss():
+    """
+    The current resident set size of the process in bytes, or None without
+    /proc/self/statm.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (IOError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+
+class MemoryTracker(object):
+    """
+    Record the peak memory of named stages, which may be nested. Tracing
+    slows allocations down, so a disabled tracker records nothing.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = []
+        # The traced peak reached by each running stage before the peak was
+        # last reset for a stage nested in it
+        self._peaks = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        rss_before = current_rss()
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        if self._peaks:
+            self._peaks[-1] = max(self._peaks[-1], tracemalloc.get_traced_memory()[1])
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        else:
+            # Before Python 3.9 the peak is only reset along with the traces
+            tracemalloc.clear_traces()
+            baseline = 0
+        self._peaks.append(0)
+        try:
+            yield
+        finally:
+            peak = max(self._peaks.pop(), tracemalloc.get_traced_memory()[1])
+            traced_peak = max(peak - baseline, 0)
+            if started:
+                tracemalloc.stop()
+            self.stages.append(Stage(name, traced_peak, rss_before, current_rss()))
+
+    def peak(self):
+        """The largest traced peak of all stages, in bytes."""
+        return max([stage.traced_peak for stage in self.stages] or [0])
+
+    def log_report(self):
+        for stage in self.stages:
+            if stage.rss_before is None or stage.rss_after is None:
+                rss = "n/a"
+            else:
+                rss = "%.1f -> %.1f MiB" % (stage.rss_before / MIB, stage.rss_after / MIB)
+            log.info(
+                "memory: %s peaked at %.1f MiB traced, process RSS %s"
+                % (stage.name, stage.traced_peak / MIB, rss)
+            )
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+'''
+Summarize the slice geometry of a series from the headers of all of its
+instances: slice count and spacing, gaps, orientation consistency, mosaic
+and localizer detection.
+
+The positions and orientations of the instances are collected into NumPy
+arrays, so that a series of thousands of slices is summarized at once:
+
+    positions, orientations, mosaic = geometry_arrays(headers)
+    summary = summarize(positions, orientations, mosaic)
+'''
+
+import struct
+import numpy as np
+
+import pydicom
+
+# Siemens NumberOfImagesInMosaic, the number of slices tiled in a mosaic
+MOSAIC_IMAGES_TAG = pydicom.tag.Tag(0x0019, 0x100A)
+
+# Header fields the summary is computed from
+GEOMETRY_TAGS = [
+    "ImagePositionPatient",
+    "ImageOrientationPatient",
+    "ImageType",
+    MOSAIC_IMAGES_TAG,
+]
+
+# Orientations within this tolerance of direction cosines are the same
+ORIENTATION_TOLERANCE = 1e-3
+
+# Slice positions along the normal, in mm, are the same within this tolerance
+POSITION_DECIMALS = 3
+
+# Planes whose normals have an absolute dot product below this are orthogonal
+ORTHOGONAL_TOLERANCE = 0.1
+
+# A spacing this many times the median spacing is a gap
+GAP_FACTOR = 1.5
+
+# Spacings are uniform when within this fraction of the median spacing
+UNIFORM_TOLERANCE = 0.01
+
+
+def _vector(value, size):
+    try:
+        vector = [float(v) for v in value]
+    except (TypeError, ValueError):
+        return None
+    return vector if len(vector) == size else None
+
+
+def mosaic_images(header):
+    """The number of images of a Siemens mosaic, None if unknown."""
+    element = header.get(MOSAIC_IMAGES_TAG)
+    if element is None:
+        return None
+    value = element.value
+    # Implicit VR datasets leave the private element undecoded
+    if isinstance(value, bytes):
+        if len(value) < 2:
+            return None
+        value = struct.unpack("<H", value[:2])[0]
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def geometry_arrays(headers):
+    """
+    Collect the ImagePositionPatient of headers into a float array shaped
+    (headers, 3), their ImageOrientationPatient into one shaped (headers,
+    6), NaN when missing, and whether their ImageType is MOSAIC into a bool
+    array.
+    """
+    positions = np.full((len(headers), 3), np.nan)
+    orientations = np.full((len(headers), 6), np.nan)
+    mosaic = np.zeros(len(headers), dtype=bool)
+    for n, header in enumerate(headers):
+        position = _vector(header.get("ImagePositionPatient"), 3)
+        if position is not None:
+            positions[n] = position
+        orientation = _vector(header.get("ImageOrientationPatient"), 6)
+        if orientation is not None:
+            orientations[n] = orientation
+        image_type = header.get("ImageType") or []
+        if isinstance(image_type, str):
+            image_type = image_type.split("\\")
+        mosaic[n] = "MOSAIC" in [str(t).strip().upper() for t in image_type]
+    return positions, orientations, mosaic
+
+
+def _unique_rows(array, tolerance):
+    return np.unique(np.round(array / tolerance).astype(np.int64), axis=0) * tolerance
+
+
+def _has_orthogonal_triplet(normals):
+    # Three planes whose normals are pairwise orthogonal: a triangle in the
+    # graph of orthogonal pairs
+    orthogonal = (np.abs(normals @ normals.T) < ORTHOGONAL_TOLERANCE).astype(np.int64)
+    return bool((orthogonal * (orthogonal @ orthogonal)).any())
+
+
+def summarize(positions, orientations, mosaic=None, mosaic_slices=None):
+    """
+    Summarize the geometry of a series from the arrays of geometry_arrays.
+
+    Slices are the distinct positions along the normal of the series, so
+    that the volumes of a time series count once. Spacing and gaps are only
+    reported when all instances share an orientation.
+    """
+    instances = len(positions)
+    if mosaic is None:
+        mosaic = np.zeros(instances, dtype=bool)
+    summary = {
+        "Instances": instances,
+        "Mosaic": bool(mosaic.any()),
+    }
+    valid = np.isfinite(positions).all(axis=1) & np.isfinite(orientations).all(axis=1)
+    if not valid.any():
+        return summary
+    positions = positions[valid]
+    orientations = orientations[valid]
+
+    unique_orientations = _unique_rows(orientations, ORIENTATION_TOLERANCE)
+    normals = np.cross(unique_orientations[:, :3], unique_orientations[:, 3:])
+    lengths = np.linalg.norm(normals, axis=1)
+    normals = normals[lengths > 0] / lengths[lengths > 0, None]
+    summary["Orientations"] = len(unique_orientations)
+    summary["OrientationConsistent"] = len(unique_orientations) == 1
+    summary["Localizer"] = len(normals) >= 3 and _has_orthogonal_triplet(normals)
+    if len(unique_orientations) != 1 or not len(normals):
+        return summary
+
+    locations = np.unique(np.round(positions @ normals[0], POSITION_DECIMALS))
+    slices = len(locations)
+    if summary["Mosaic"] and mosaic_slices:
+        slices = mosaic_slices
+    summary["SliceCount"] = int(slices)
+    if len(locations) > 1:
+        spacings = np.diff(locations)
+        spacing = float(np.median(spacings))
+        summary["SliceSpacing"] = round(spacing, 4)
+        summary["SliceSpacingMin"] = round(float(spacings.min()), 4)
+        summary["SliceSpacingMax"] = round(float(spacings.max()), 4)
+        summary["Gaps"] = int((spacings > GAP_FACTOR * spacing).sum())
+        summary["UniformSpacing"] = bool(
+            (np.abs(spacings - spacing) <= UNIFORM_TOLERANCE * spacing).all()
+        )
+    return summary
+
+
+def summarize_headers(headers):
+    """Summarize the geometry of a series from the headers of its instances."""
+    positions, orientations, mosaic = geometry_arrays(headers)
+    mosaic_slices = None
+    if mosaic.any():
+        mosaic_slices = next(
+            (n for n in (mosaic_images(header) for header in headers) if n), None
+        )
+    return summarize(positions, orientations, mosaic, mosaic_slices)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+'''
+Generate a large, deterministic corpus of SeriesDescription labels from the
+vocabulary of test_classifications.csv, and compare a candidate label
+classifier against a reference implementation on it.
+
+    python tests/label_corpus.py --count 1000000
+    python tests/label_corpus.py --reference /path/to/old/classification_from_label.py
+'''
+
+import io
+import os
+import csv
+import sys
+import json
+import time
+import random
+import itertools
+import contextlib
+import importlib.util
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+base_dir = os.path.abspath(os.path.join(test_dir, '..'))
+sys.path.append(base_dir)
+
+LABELS_FILE = os.path.join(test_dir, 'test_classifications.csv')
+
+VENDOR_PREFIXES = ['', '', '', 'WIP ', 'WIP_', 'MR_', 'SIEMENS_', 'GE_', 'Philips ',
+                   'sT1W_', 'cs_', 'Ax ', 'Sag ', 'COR_', 'ORIG_', 'DEV_']
+SUFFIXES = ['', '', '', '_ADC', '_FA', '_TRACEW', '_ColFA', '_EXP', '_SBRef',
+            '_PhysioLog', '_MoCo', '_ND', '_Pha', '_Mag', '_e1', '_e2', '_ph']
+NUMERIC_TAILS = ['', '', '', '_p2', '_1.0mm', '_64dir', '_run-01', '_3', '_iso0.8',
+                 '_2x2x2', '_s008', ' 2', '_TR2000', '_b1000', '_AP', '_PA']
+SEPARATORS = ['_', ' ', '-', '__']
+
+
+def load_labels(labels_file=LABELS_FILE):
+    """The hand-curated labels that seed the corpus."""
+    with open(labels_file, 'r') as f:
+        return [row[0] for row in csv.reader(f) if row and row[0]]
+
+
+def generate_labels(count, seed=0, labels=None):
+    """
+    Yield count labels derived from the curated labels: tokens recombined
+    across labels, separators and case changed, vendor prefixes, derived
+    suffixes and protocol tails added. The same seed yields the same labels.
+    """
+    labels = labels or load_labels()
+    tokens = sorted(set(itertools.chain.from_iterable(_tokens(l) for l in labels)))
+    rng = random.Random(seed)
+    for _ in range(count):
+        parts = _tokens(rng.choice(labels))
+        # Splice in tokens from elsewhere in the vocabulary
+        for _ in range(rng.choice([0, 0, 1, 2])):
+            parts.insert(rng.randint(0, len(parts)), rng.choice(tokens))
+        label = rng.choice(SEPARATORS).join(parts)
+
+        case = rng.random()
+        if case < 0.15:
+            label = label.lower()
+        elif case < 0.3:
+            label = label.upper()
+
+        yield (rng.choice(VENDOR_PREFIXES) + label + rng.choice(SUFFIXES) +
+               rng.choice(NUMERIC_TAILS))
+
+
+def _tokens(label):
+    parts = [p for p in label.replace('-', '_').replace(' ', '_').split('_') if p]
+    return parts or [label]
+
+
+def load_classifier(path):
+    """Load infer_classification from a classification_from_label.py file."""
+    spec = importlib.util.spec_from_file_location('reference_classification', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.infer_classification
+
+
+def compare(candidate, reference, labels, chunk_size=10000, max_mismatches=20):
+    """
+    Classify labels with both classifiers, timing each of them in chunks.
+    Returns the number of labels, the mismatches found (label, candidate
+    result, reference result), the total number of mismatches and the
+    labels per second of each classifier.
+    """
+    labels = iter(labels)
+    total = 0
+    mismatches = []
+    mismatch_count = 0
+    candidate_seconds = 0.0
+    reference_seconds = 0.0
+    while True:
+        chunk = list(itertools.islice(labels, chunk_size))
+        if not chunk:
+            break
+        # Unknown labels are printed by the classifier, keep them out of the way
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            candidate_results = [candidate(label) for label in chunk]
+            candidate_seconds += time.perf_counter() - start
+
+            start = time.perf_counter()
+            reference_results = [reference(label) for label in chunk]
+            reference_seconds += time.perf_counter() - start
+
+        for label, result, expected in zip(chunk, candidate_results, reference_results):
+            # Compare serialized results, so that key order counts too
+            if json.dumps(result) != json.dumps(expected):
+                mismatch_count += 1
+                if len(mismatches) < max_mismatches:
+                    mismatches.append((label, result, expected))
+        total += len(chunk)
+
+    return {
+        'labels': total,
+        'mismatches': mismatches,
+        'mismatch_count': mismatch_count,
+        'candidate_labels_per_second': total / candidate_seconds if candidate_seconds else 0.0,
+        'reference_labels_per_second': total / reference_seconds if reference_seconds else 0.0,
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+    import classification_from_label
+
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--count', type=int, default=100000, help='number of labels to generate')
+    ap.add_argument('--seed', type=int, default=0, help='random seed of the generator')
+    ap.add_argument('--candidate', help='classification_from_label.py to test [default: this tree]')
+    ap.add_argument('--reference',
+                    help='classification_from_label.py to compare against '
+                         '[default: infer_classification_chain of this tree]')
+    ap.add_argument('--write', help='write the corpus to this file instead of comparing')
+    args = ap.parse_args()
+
+    corpus = generate_labels(args.count, seed=args.seed)
+    if args.write:
+        with open(args.write, 'w') as f:
+            for label in corpus:
+                f.write(label + '\n')
+        sys.exit(0)
+
+    candidate = (load_classifier(args.candidate) if args.candidate
+                 else classification_from_label.infer_classification)
+    reference = (load_classifier(args.reference) if args.reference
+                 else classification_from_label.infer_classification_chain)
+
+    result = compare(candidate, reference, corpus)
+    for label, got, expected in result['mismatches']:
+        print('MISMATCH %r: candidate %s, reference %s' % (label, got, expected))
+    print('%d labels, %d mismatches' % (result['labels'], result['mismatch_count']))
+    print('candidate: %.0f labels/s' % result['candidate_labels_per_second'])
+    print('reference: %.0f labels/s' % result['reference_labels_per_second'])
+    sys.exit(1 if result['mismatch_count'] else 0)
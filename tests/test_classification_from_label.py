@@ -8,6 +8,7 @@ import pytest
 test_dir = os.path.dirname(__file__)
 base_dir = os.path.abspath(os.path.join(test_dir, '..'))
 sys.path.append(base_dir)
+import classification_from_label
 from classification_from_label import infer_classification
 
 KEYS = ['Intent', 'Measurement', 'Features', 'Custom']
@@ -45,3 +46,28 @@ def test_measurement_from_empty_label():
     assert infer_classification('') == {}
     assert infer_classification('hkjl') == {}
     
+
+def test_profiling():
+    profile = classification_from_label.enable_profiling()
+    try:
+        assert infer_classification('fMRI_rest') == {'Intent': ['Functional'], 'Measurement': ['T2*']}
+    finally:
+        assert classification_from_label.disable_profiling() is profile
+
+    # The chain stopped at the first rule that matched
+    assert profile.rules['is_functional'][:2] == [1, 1]
+    assert profile.rules['is_fieldmap'][:2] == [1, 0]
+    assert 'is_anatomy_t1' not in profile.rules
+    assert profile.patterns[('is_functional', 'fmri')][:2] == [1, 1]
+    assert ('is_functional', 'rest') not in profile.patterns
+
+def test_primary_matcher_matches_chain():
+    # The combined matcher picks the same rule as calling the predicates in turn
+    test_file = os.path.join(test_dir, 'test_classifications.csv')
+    with open(test_file, 'r') as f:
+        labels = [row[0] for row in csv.reader(f)]
+    labels += ['REST', 'rest', 'PD', 'pd_t2', 'ret_bars', 'ret\nbars', 'bars\nret',
+               'fieldmap', 'se_ap', 'T2*', 'screenshot', 'hkjl']
+    for label in labels:
+        assert classification_from_label.primary_rule(label) == \
+            classification_from_label.primary_rule_chain(label), label
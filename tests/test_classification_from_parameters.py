@@ -0,0 +1,85 @@
+import os
+import sys
+
+import numpy as np
+import pydicom
+import pytz
+from pydicom.data import get_testdata_file
+
+test_dir = os.path.dirname(__file__)
+base_dir = os.path.abspath(os.path.join(test_dir, '..'))
+sys.path.append(base_dir)
+import classification_from_parameters
+import dicom_mr_classifier
+
+HEADERS = [
+    ({'EchoTime': 30, 'RepetitionTime': 2000, 'ScanningSequence': 'EP'},
+     {'Intent': ['Functional'], 'Measurement': ['T2*']}),
+    ({'EchoTime': 2.3, 'RepetitionTime': 2300, 'InversionTime': 900, 'ScanningSequence': ['GR', 'IR']},
+     {'Intent': ['Structural'], 'Measurement': ['T1']}),
+    ({'EchoTime': 90, 'RepetitionTime': 9000, 'InversionTime': 2500, 'ScanningSequence': 'SE\\IR'},
+     {'Intent': ['Structural'], 'Measurement': ['T2'], 'Features': ['FLAIR']}),
+    ({'EchoTime': 89, 'RepetitionTime': 9000, 'ScanningSequence': 'EP', 'SequenceName': '*ep_b1000#1'},
+     {'Intent': ['Structural'], 'Measurement': ['Diffusion']}),
+    ({'ImageType': ['DERIVED', 'PRIMARY', 'DIFFUSION', 'ADC']},
+     {'Intent': ['Structural'], 'Measurement': ['Diffusion'], 'Features': ['Derived']}),
+    ({'EchoTime': 20, 'RepetitionTime': 600, 'ScanningSequence': 'SE'},
+     {'Intent': ['Structural'], 'Measurement': ['T1']}),
+    ({'EchoTime': 100, 'RepetitionTime': 4000, 'ScanningSequence': 'SE'},
+     {'Intent': ['Structural'], 'Measurement': ['T2']}),
+    ({'ScanningSequence': 'SE'}, {}),
+    ({}, {}),
+]
+
+
+def test_classify_headers():
+    headers = [header for header, _ in HEADERS]
+    expected = [classification for _, classification in HEADERS]
+    assert classification_from_parameters.classify_headers(headers) == expected
+
+
+def test_classify_arrays_in_one_pass():
+    headers = [header for header, _ in HEADERS] * 1000
+    values, flags = classification_from_parameters.parameter_arrays(headers)
+    assert values.shape == (len(headers), len(classification_from_parameters.PARAMETERS))
+    assert flags.shape == (len(headers), len(classification_from_parameters.FLAGS))
+    rules = classification_from_parameters.match_rules(values, flags)
+    assert (rules[:len(HEADERS)] == rules.reshape(1000, len(HEADERS))).all()
+    assert rules[-1] == -1
+    assert np.isnan(values[-1]).all()
+
+
+def test_parameter_classification_of_unknown_label():
+    dcm = pydicom.dcmread(get_testdata_file('MR_small.dcm'))
+    dcm.SeriesDescription = 'protocol 7'
+    config = {'config': {'parameter_classification': True}, 'inputs': {}}
+    metadata = dicom_mr_classifier.classify_dataset(dcm, pytz.utc, config, name='mr')
+    assert metadata['acquisition']['files'][0]['classification'] == {
+        'Intent': ['Structural'], 'Measurement': ['T2']}
+
+    metadata = dicom_mr_classifier.classify_dataset(dcm, pytz.utc, name='mr')
+    assert metadata['acquisition']['files'][0]['classification'] == {'Custom': ['N/A']}
+
+
+def test_parameter_batch_matches_single_classification(tmpdir):
+    paths = []
+    for n, description in enumerate(['protocol 7', 'T1w_MPR', '']):
+        dcm = pydicom.dcmread(get_testdata_file('MR_small.dcm'))
+        dcm.SeriesDescription = description
+        if not description:
+            del dcm.PixelData
+        paths.append(str(tmpdir.join('%d.dcm' % n)))
+        dcm.save_as(paths[-1])
+    config = {'config': {'parameter_classification': True}, 'inputs': {}}
+
+    batch = classification_from_parameters.Batch()
+    batched = [
+        dicom_mr_classifier.classify_input(path, pytz.utc, config, parameter_batch=batch)
+        for path in paths
+    ]
+    assert len(batch) == 2
+    assert batched[0]['acquisition']['files'][0]['classification'] == {'Custom': ['N/A']}
+    batch.classify()
+    assert len(batch) == 0
+    for path, metadata in zip(paths, batched):
+        assert metadata == dicom_mr_classifier.classify_input(path, pytz.utc, config)
@@ -0,0 +1,87 @@
+import os
+import sys
+
+import pydicom
+import pytz
+from pydicom.data import get_testdata_file
+
+test_dir = os.path.dirname(__file__)
+base_dir = os.path.abspath(os.path.join(test_dir, '..'))
+sys.path.append(base_dir)
+import classification_index
+import dicom_mr_classifier
+
+
+def write_input(tmpdir, name, description):
+    dcm = pydicom.dcmread(get_testdata_file('MR_small.dcm'))
+    dcm.SeriesDescription = description
+    path = str(tmpdir.join(name))
+    dcm.save_as(path)
+    return path
+
+
+def test_index_and_query(tmpdir):
+    functional = write_input(tmpdir, 'rest.dcm', 'fMRI_rest')
+    structural = write_input(tmpdir, 't1.dcm', 'T1w_MPR')
+    db_path = str(tmpdir.join('index.db'))
+
+    with classification_index.ClassificationIndex(db_path) as index:
+        assert classification_index.index_inputs(index, [functional, structural], pytz.utc) == 2
+        # Unchanged inputs are skipped, touched ones only rehashed
+        os.utime(structural, (0, 0))
+        assert classification_index.index_inputs(index, [functional, structural], pytz.utc) == 0
+
+    write_input(tmpdir, 't1.dcm', 'T2w_SPC')
+    with classification_index.ClassificationIndex(db_path) as index:
+        assert classification_index.index_inputs(index, [functional, structural], pytz.utc) == 1
+
+        [entry] = index.query(Intent='Functional')
+        assert entry['input_path'] == functional
+        assert entry['label'] == 'fMRI_rest'
+        assert entry['classification'] == {'Intent': ['Functional'], 'Measurement': ['T2*']}
+
+        [entry] = index.query(Measurement='T2', modality='MR')
+        assert entry['input_path'] == structural
+        assert entry['Manufacturer'] == 'TOSHIBA_MEC'
+        assert len(list(index.query(Manufacturer='TOSHIBA_MEC', EchoTime='240'))) == 2
+        assert list(index.query(Measurement='T1')) == []
+
+    # An indexed input removed since is skipped, the others still indexed
+    os.remove(functional)
+    write_input(tmpdir, 't1.dcm', 'T1w_MPR')
+    with classification_index.ClassificationIndex(db_path) as index:
+        assert classification_index.index_inputs(index, [functional, structural], pytz.utc) == 1
+
+
+def test_query_numeric_strings(tmpdir):
+    path = write_input(tmpdir, 'rest.dcm', 'fMRI_rest')
+    dcm = pydicom.dcmread(path)
+    dcm.DeviceSerialNumber = '45321'
+    dcm.StationName = '007'
+    dcm.save_as(path)
+    db_path = str(tmpdir.join('index.db'))
+
+    with classification_index.ClassificationIndex(db_path) as index:
+        assert classification_index.index_inputs(index, [path], pytz.utc) == 1
+        assert len(list(index.query(DeviceSerialNumber='45321'))) == 1
+        assert len(list(index.query(StationName='007'))) == 1
+        assert len(list(index.query(StationName='7'))) == 0
+        # Numeric VRs are stored as numbers
+        assert len(list(index.query(EchoTime='240'))) == 1
+        assert len(list(index.query(EchoTime=240))) == 1
+
+
+def test_upsert_not_committed(tmpdir):
+    path = write_input(tmpdir, 'rest.dcm', 'fMRI_rest')
+    db_path = str(tmpdir.join('index.db'))
+    metadata = dicom_mr_classifier.classify_input(path, pytz.utc)
+
+    index = classification_index.ClassificationIndex(db_path)
+    index.upsert(path, metadata)
+    assert len(list(index.query(Intent='Functional'))) == 1
+    index.close()
+    with classification_index.ClassificationIndex(db_path) as index:
+        assert list(index.query(Intent='Functional')) == []
+        index.upsert(path, metadata)
+    with classification_index.ClassificationIndex(db_path) as index:
+        assert len(list(index.query(Intent='Functional'))) == 1
@@ -0,0 +1,68 @@
+import os
+import sys
+import json
+import shutil
+
+import pydicom
+import pytz
+from pydicom.data import get_testdata_file
+
+test_dir = os.path.dirname(__file__)
+base_dir = os.path.abspath(os.path.join(test_dir, '..'))
+sys.path.append(base_dir)
+import classification_rules
+import dicom_mr_classifier
+
+
+def write_sources(tmpdir, classifications):
+    label_rules_path = str(tmpdir.join('classification_from_label.py'))
+    shutil.copy(classification_rules.LABEL_RULES_PATH, label_rules_path)
+    custom_path = str(tmpdir.join('classifications.json'))
+    with open(custom_path, 'w') as f:
+        json.dump(classifications, f)
+    return label_rules_path, custom_path
+
+
+def touch(path, mtime):
+    os.utime(path, (mtime, mtime))
+
+
+def test_reload_on_change(tmpdir):
+    label_rules_path, custom_path = write_sources(tmpdir, {'/rest/': 'Intent:Functional'})
+    touch(custom_path, 1000)
+    rules = classification_rules.ReloadingRules(label_rules_path, custom_path)
+    version = rules.version
+
+    dcm = pydicom.dcmread(get_testdata_file('MR_small.dcm'))
+    dcm.SeriesDescription = 'my_rest_scan'
+    metadata = dicom_mr_classifier.classify_dataset(dcm, pytz.utc, rules=rules)
+    entry = metadata['acquisition']['files'][0]
+    assert entry['classification'] == {'Intent': ['Functional']}
+    assert entry['classification_rules'] == version
+
+    # Unchanged sources are not recompiled
+    assert not rules.check()
+
+    with open(custom_path, 'w') as f:
+        json.dump({'inputs': {'classifications': {'value': {'/rest/': 'Custom:Resting'}}}}, f)
+    touch(custom_path, 2000)
+    assert rules.check()
+    assert rules.version != version
+    metadata = dicom_mr_classifier.classify_dataset(dcm, pytz.utc, rules=rules)
+    entry = metadata['acquisition']['files'][0]
+    assert entry['classification'] == {'Custom': ['Resting']}
+    assert entry['classification_rules'] == rules.version
+
+
+def test_keep_rules_that_fail_to_compile(tmpdir):
+    label_rules_path, custom_path = write_sources(tmpdir, {})
+    touch(label_rules_path, 1000)
+    rules = classification_rules.ReloadingRules(label_rules_path, custom_path)
+    current = rules.current
+
+    with open(label_rules_path, 'a') as f:
+        f.write('\ndef broken(:\n')
+    touch(label_rules_path, 2000)
+    assert not rules.check()
+    assert rules.current is current
+    assert rules.current.infer_classification('T1w_MPR') == {'Intent': ['Structural'], 'Measurement': ['T1']}
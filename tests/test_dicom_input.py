@@ -0,0 +1,267 @@
+import io
+import os
+import sys
+import tarfile
+import zipfile
+
+import pydicom
+import pytest
+from pydicom.data import get_testdata_file
+
+test_dir = os.path.dirname(__file__)
+base_dir = os.path.abspath(os.path.join(test_dir, '..'))
+sys.path.append(base_dir)
+import dicom_input
+
+DICOM_FILES = ['CT_small.dcm', 'MR_small.dcm', 'rtplan.dcm']
+
+
+def write_inputs(tmpdir):
+    # The same three DICOM files as a directory, zip, tar and tar.gz input
+    directory = tmpdir.mkdir('dicom')
+    for name in DICOM_FILES:
+        with open(get_testdata_file(name), 'rb') as f:
+            directory.join(name).write_binary(f.read())
+
+    zip_path = str(tmpdir.join('dicom.zip'))
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name in DICOM_FILES:
+            zf.write(str(directory.join(name)), name)
+
+    tar_paths = []
+    for mode, ext in [('w', 'tar'), ('w:gz', 'tar.gz')]:
+        tar_path = str(tmpdir.join('dicom.' + ext))
+        with tarfile.open(tar_path, mode) as tf:
+            for name in DICOM_FILES:
+                tf.add(str(directory.join(name)), name)
+        tar_paths.append(tar_path)
+
+    return [str(directory), zip_path] + tar_paths
+
+
+def test_input_kind(tmpdir):
+    directory, zip_path, tar_path, tgz_path = write_inputs(tmpdir)
+    assert dicom_input.input_kind(directory) == dicom_input.DIRECTORY
+    assert dicom_input.input_kind(zip_path) == dicom_input.ZIP
+    assert dicom_input.input_kind(tar_path) == dicom_input.TAR
+    assert dicom_input.input_kind(tgz_path) == dicom_input.TAR
+    assert dicom_input.input_kind(get_testdata_file('MR_small.dcm')) == dicom_input.FILE
+
+
+def test_iter_members(tmpdir):
+    for path in write_inputs(tmpdir):
+        names = []
+        for member in dicom_input.iter_members(path):
+            with open(get_testdata_file(member.name), 'rb') as f:
+                expected = f.read()
+            assert member.size == len(expected)
+            with member.open() as fileobj:
+                assert fileobj.read() == expected
+            names.append(member.name)
+        assert names == DICOM_FILES
+
+
+def test_read_representative(tmpdir):
+    # Every kind of input picks the last member, whatever the access order
+    for path in write_inputs(tmpdir):
+        dcm = dicom_input.read_representative(path)
+        assert dcm.Modality == 'RTPLAN'
+
+
+def test_read_series_representatives(tmpdir):
+    # Each of the three files belongs to its own series
+    for path in write_inputs(tmpdir):
+        with dicom_input.open_input(path) as dicom:
+            series = dicom_input.group_series(dicom)
+        assert len(series) == 3
+        dcms = dicom_input.read_series_representatives(path)
+        assert sorted(dcm.Modality for dcm in dcms) == ['CT', 'MR', 'RTPLAN']
+        assert [dcm.SeriesInstanceUID for dcm in dcms] == list(series.keys())
+
+
+def test_read_tar_series_representatives_in_one_pass(tmpdir, monkeypatch):
+    # One series whose last member is Raw Data
+    tar_path = str(tmpdir.join('series.tar.gz'))
+    zip_path = str(tmpdir.join('series.zip'))
+    with tarfile.open(tar_path, 'w:gz') as tf, zipfile.ZipFile(zip_path, 'w') as zf:
+        for n in range(3):
+            dcm = pydicom.dcmread(get_testdata_file('MR_small.dcm'))
+            dcm.InstanceNumber = n
+            if n == 2:
+                dcm.SOPClassUID = dicom_input.RAW_DATA_STORAGE
+            path = str(tmpdir.join('%d.dcm' % n))
+            dcm.save_as(path)
+            tf.add(path, '%d.dcm' % n)
+            zf.write(path, '%d.dcm' % n)
+
+    passes = []
+    members = dicom_input.DicomInput.members
+
+    def counted_members(self, *args, **kwargs):
+        passes.append(self.kind)
+        return members(self, *args, **kwargs)
+
+    monkeypatch.setattr(dicom_input.DicomInput, 'members', counted_members)
+    [dcm] = dicom_input.read_series_representatives(tar_path)
+    assert passes == [dicom_input.TAR]
+    assert dcm.InstanceNumber == 1
+    [dcm] = dicom_input.read_series_representatives(zip_path)
+    assert dcm.InstanceNumber == 1
+
+
+def test_pick_representative():
+    assert dicom_input.pick_representative([('a', False), ('b', False), ('c', True)]) == 'b'
+    assert dicom_input.pick_representative([('a', True), ('b', True)]) == 'a'
+
+
+def test_read_mapped_member(tmpdir):
+    # Stored zip members and plain files are read in place, up to the pixel data
+    zip_path = str(tmpdir.join('stored.zip'))
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zf:
+        for name in DICOM_FILES:
+            zf.write(get_testdata_file(name), name)
+
+    with dicom_input.open_input(zip_path) as dicom:
+        for member in dicom.members():
+            assert member.map is not None
+            full = pydicom.dcmread(get_testdata_file(member.name))
+            mapped = dicom_input.read_member(member)
+            assert 'PixelData' not in mapped
+            assert dicom_input.has_pixel_data(mapped) == ('PixelData' in full)
+            assert sorted(mapped.keys()) == sorted(t for t in full.keys() if t != 0x7FE00010)
+            assert mapped.SeriesInstanceUID == full.SeriesInstanceUID
+
+    member = next(dicom_input.iter_members(get_testdata_file('MR_small.dcm')))
+    assert member.map is not None
+    assert dicom_input.has_pixel_data(dicom_input.read_member(member))
+
+
+def test_spool():
+    data = b'0123456789' * 1000
+    in_memory = dicom_input.spool(io.BytesIO(data), len(data))
+    assert isinstance(in_memory, io.BytesIO)
+    assert in_memory.read() == data
+
+    spilled = dicom_input.spool(io.BytesIO(data), 100)
+    assert not isinstance(spilled, io.BytesIO)
+    assert spilled.read() == data
+    spilled.close()
+
+
+def test_file_object_inputs(tmpdir):
+    # Archives and files can be read from file objects as well as paths
+    for path in write_inputs(tmpdir)[1:] + [get_testdata_file('MR_small.dcm')]:
+        with open(path, 'rb') as f:
+            fileobj = io.BytesIO(f.read())
+        assert dicom_input.input_kind(fileobj) == dicom_input.input_kind(path)
+        assert dicom_input.read_representative(fileobj).SOPInstanceUID == \
+            dicom_input.read_representative(path).SOPInstanceUID
+
+
+def test_map_members_read_ahead():
+    import threading
+    import time
+
+    in_flight = []
+    lock = threading.Lock()
+
+    def work(n):
+        with lock:
+            in_flight.append(n)
+        time.sleep(0.001)
+        return n * n
+
+    results = dicom_input.map_members(work, range(100), workers=4, read_ahead=8)
+    assert list(results) == [n * n for n in range(100)]
+
+    # Stopping early leaves the members past the read-ahead alone
+    del in_flight[:]
+    results = dicom_input.map_members(work, range(100), workers=4, read_ahead=8)
+    assert next(results) == 0
+    results.close()
+    assert len(in_flight) <= 9
+
+
+def write_dicomdir_export(tmpdir):
+    # pydicom's DICOMDIR test export, as a directory and a zip input
+    import shutil
+    source = os.path.dirname(get_testdata_file('dicomdirtests/DICOMDIR'))
+    directory = tmpdir.mkdir('export')
+    shutil.copy(os.path.join(source, 'DICOMDIR'), str(directory))
+    for name in ['77654033', '98892001', '98892003']:
+        shutil.copytree(os.path.join(source, name), str(directory.join(name)))
+
+    zip_path = str(tmpdir.join('export.zip'))
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for member in dicom_input.iter_members(str(directory)):
+            zf.write(str(directory.join(member.name)), member.name)
+    return str(directory), zip_path
+
+
+def test_dicomdir_index(tmpdir):
+    directory, zip_path = write_dicomdir_export(tmpdir)
+    for path in [directory, zip_path]:
+        with dicom_input.open_input(path) as dicom:
+            records = dicom_input.read_dicomdir(dicom)
+            assert [r.name for r in records] == [n for n in dicom.names() if n != 'DICOMDIR']
+            series = dicom_input.group_series(dicom)
+            last_image = dicom_input.read_member(dicom.member(records[-1].name))
+            # Reading tags along gives the headers of every member of each series
+            grouped, headers = dicom_input.group_series(dicom, tags=['InstanceNumber'])
+        assert grouped == series
+        assert [len(h) for h in headers.values()] == [len(m) for m in series.values()]
+        assert len(series) == 13
+        assert dicom_input.read_representative(path).SOPInstanceUID == last_image.SOPInstanceUID
+
+    # Without the DICOMDIR, the headers of the members group them the same way
+    os.remove(os.path.join(directory, 'DICOMDIR'))
+    with dicom_input.open_input(directory) as dicom:
+        assert dicom_input.read_dicomdir(dicom) is None
+        assert dicom_input.group_series(dicom) == series
+
+
+def test_dicomdir_index_limits(tmpdir):
+    directory, zip_path = write_dicomdir_export(tmpdir)
+    budgets = [
+        {'max_members': 2},
+        {'max_member_size': 100},
+        {'max_total_size': 100},
+        {'timeout': 1e-9},
+    ]
+    for path in [directory, zip_path]:
+        for budget in budgets:
+            for read in [dicom_input.read_representative, dicom_input.read_series_representatives]:
+                with pytest.raises(dicom_input.InputLimitError):
+                    read(path, limits=dicom_input.InputLimits(**budget))
+
+
+def test_zip_closed_when_over_limits(tmpdir):
+    _, zip_path = write_dicomdir_export(tmpdir)
+    with pytest.raises(dicom_input.InputLimitError) as excinfo:
+        dicom_input.open_input(zip_path, dicom_input.InputLimits(max_members=2))
+    [dicom] = [entry.frame.f_locals['self'] for entry in excinfo.traceback if entry.name == '__init__']
+    assert dicom._zip.fp is None
+
+
+def test_dicomdir_skips_non_image_records(tmpdir):
+    directory, _ = write_dicomdir_export(tmpdir)
+    with dicom_input.open_input(directory) as dicom:
+        series = dicom_input.group_series(dicom)
+    members = [members for members in series.values() if len(members) > 1][0]
+    last = members[-1][0]
+
+    # Make the last record of the series a report
+    dicomdir_path = os.path.join(directory, 'DICOMDIR')
+    with open(dicomdir_path, 'rb') as f:
+        data = f.read()
+    image_type = b'CS\x06\x00IMAGE '
+    offset = data.rindex(image_type, 0, data.index(last.replace(os.sep, '\\').encode()))
+    data = data[:offset] + b'CS\x06\x00REPORT' + data[offset + len(image_type):]
+    with open(dicomdir_path, 'wb') as f:
+        f.write(data)
+
+    with dicom_input.open_input(directory) as dicom:
+        series = dicom_input.group_series(dicom)
+    [members] = [members for members in series.values() if members[-1][0] == last]
+    assert members[-1] == (last, True)
+    assert dicom_input.pick_representative(members) == members[-2][0]
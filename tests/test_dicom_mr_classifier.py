@@ -0,0 +1,188 @@
+import importlib.util
+import io
+import json
+import os
+import sys
+import zipfile
+
+import pydicom
+import pytest
+import pytz
+from pydicom.data import get_testdata_file
+
+test_dir = os.path.dirname(__file__)
+base_dir = os.path.abspath(os.path.join(test_dir, '..'))
+sys.path.append(base_dir)
+import dicom_mr_classifier
+
+spec = importlib.util.spec_from_file_location('dicom_mr_classifier_cli', os.path.join(base_dir, 'dicom-mr-classifier.py'))
+cli = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(cli)
+
+
+def zip_bytes(*names):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name in names:
+            zf.write(get_testdata_file(name), name)
+    return buf.getvalue()
+
+
+def test_classify_dataset():
+    dcm = pydicom.dcmread(get_testdata_file('MR_small.dcm'))
+    dcm.SeriesDescription = 'fMRI_rest'
+    metadata = dicom_mr_classifier.classify_dataset(dcm, pytz.utc, name='MR_small.dcm')
+
+    assert metadata['session']['timestamp'] == '2004-08-26T18:50:59+00:00'
+    assert metadata['acquisition']['label'] == 'fMRI_rest'
+    [dicom_file] = metadata['acquisition']['files']
+    assert dicom_file['name'] == 'MR_small.dcm'
+    assert dicom_file['modality'] == 'MR'
+    assert dicom_file['classification'] == {'Intent': ['Functional'], 'Measurement': ['T2*']}
+    assert dicom_file['info']['SeriesDescription'] == 'fMRI_rest'
+
+
+def test_classify_bytes_matches_dataset():
+    with open(get_testdata_file('MR_small.dcm'), 'rb') as f:
+        buf = f.read()
+    dcm = pydicom.dcmread(get_testdata_file('MR_small.dcm'))
+    expected = dicom_mr_classifier.classify_dataset(dcm, pytz.utc, name='mr')
+
+    assert dicom_mr_classifier.classify_bytes(buf, pytz.utc, name='mr') == expected
+    # The last file of a zip archive is classified
+    archive = zip_bytes('CT_small.dcm', 'MR_small.dcm')
+    assert dicom_mr_classifier.classify_bytes(archive, pytz.utc, name='mr') == expected
+
+
+def test_classify_bytes_split_series():
+    config = {'config': {'split_series': True}, 'inputs': {}}
+    archive = zip_bytes('CT_small.dcm', 'MR_small.dcm')
+    metadata = dicom_mr_classifier.classify_bytes(archive, pytz.utc, config, name='a.zip')
+    files = metadata['acquisition']['files']
+    assert [f['modality'] for f in files] == ['CT', 'MR']
+    assert all(f['name'].endswith('_a.zip') for f in files)
+
+
+def test_classify_bytes_raises_on_invalid_input(tmpdir):
+    with tmpdir.as_cwd():
+        with pytest.raises(dicom_mr_classifier.ClassificationError):
+            dicom_mr_classifier.classify_bytes(b'not a dicom file', pytz.utc)
+        assert tmpdir.listdir() == []
+
+
+def test_classify_dataset_header_projection():
+    dcm = pydicom.dcmread(get_testdata_file('MR_small.dcm'))
+    config = {'config': {'header_include': 'Patient*, (0008,0060)'}, 'inputs': {}}
+    metadata = dicom_mr_classifier.classify_dataset(dcm, pytz.utc, config, name='mr')
+    info = metadata['acquisition']['files'][0]['info']
+    assert info and all(key.startswith('Patient') or key == 'Modality' for key in info)
+
+    config = {'config': {'header_exclude': ['Patient*', '(0008,xxxx)']}, 'inputs': {}}
+    metadata = dicom_mr_classifier.classify_dataset(dcm, pytz.utc, config, name='mr')
+    info = metadata['acquisition']['files'][0]['info']
+    assert 'EchoTime' in info
+    assert not any(key.startswith('Patient') or key == 'Modality' for key in info)
+
+
+def test_header_projection_include_kinds():
+    # Include patterns of one kind leave out the fields of the other kind
+    projection = dicom_mr_classifier.HeaderProjection(['Patient*'])
+    assert projection.allows('PatientName')
+    assert not projection.allows('EchoTime')
+    assert not projection.allows_any_csa()
+    assert not projection.allows_csa('B_value')
+
+    projection = dicom_mr_classifier.HeaderProjection(['csa:B_*'])
+    assert not projection.allows('PatientName')
+    assert projection.allows_any_csa()
+    assert projection.allows_csa('B_value')
+    assert not projection.allows_csa('EchoLinePosition')
+
+    projection = dicom_mr_classifier.HeaderProjection(None, ['csa:B_*'])
+    assert projection.allows('PatientName')
+    assert projection.allows_csa('EchoLinePosition')
+    assert not projection.allows_csa('B_value')
+
+    dcm = pydicom.dcmread(get_testdata_file('MR_small.dcm'))
+    config = {'config': {'header_include': 'csa:B_*'}, 'inputs': {}}
+    metadata = dicom_mr_classifier.classify_dataset(dcm, pytz.utc, config, name='mr')
+    assert metadata['acquisition']['files'][0]['info'] == {}
+
+
+def test_factor_session_info(tmpdir):
+    metadatas = []
+    for description in ['T1w', 'fMRI_rest']:
+        dcm = pydicom.dcmread(get_testdata_file('MR_small.dcm'))
+        dcm.SeriesDescription = description
+        metadatas.append(dicom_mr_classifier.classify_dataset(dcm, pytz.utc, name='mr'))
+    shared, factored = dicom_mr_classifier.factor_session_info(metadatas)
+
+    assert shared['StudyInstanceUID'] == metadatas[0]['acquisition']['files'][0]['info']['StudyInstanceUID']
+    assert [m['acquisition']['files'][0]['info'] for m in factored] == [
+        {'SeriesDescription': 'T1w'}, {'SeriesDescription': 'fMRI_rest'}]
+    for metadata, factored_metadata in zip(metadatas, factored):
+        assert dicom_mr_classifier.expand_session_info(shared, factored_metadata) == metadata
+
+    tmpdir.join(dicom_mr_classifier.SESSION_INFO_FILE).write(json.dumps(shared))
+    tmpdir.join('mr.metadata.json').write(json.dumps(factored[1]))
+    loaded = dicom_mr_classifier.load_factored_metadata(str(tmpdir.join('mr.metadata.json')))
+    assert loaded == metadatas[1]
+
+
+def test_batches_into_one_session(tmpdir):
+    # One input per batch, both of the same name and session
+    paths = []
+    for description in ['T1w', 'fMRI_rest']:
+        dcm = pydicom.dcmread(get_testdata_file('MR_small.dcm'))
+        dcm.SeriesDescription = description
+        tmpdir.mkdir(description)
+        paths.append(str(tmpdir.join(description, 'mr.dcm')))
+        dcm.save_as(paths[-1])
+    outdir = str(tmpdir.mkdir('out'))
+
+    metafiles = []
+    for path in paths:
+        list_path = tmpdir.join('inputs.txt')
+        list_path.write(path + '\n')
+        metafiles += cli.dicom_classify_batch(str(list_path), outdir, pytz.utc)
+
+    assert len(set(metafiles)) == 2
+    for path, metafile in zip(paths, metafiles):
+        loaded = dicom_mr_classifier.load_factored_metadata(metafile)
+        assert loaded == dicom_mr_classifier.classify_input(path, pytz.utc)
+    with open(metafiles[0]) as f:
+        assert json.load(f)['acquisition']['files'][0]['info'] == {'SeriesDescription': 'T1w'}
+
+
+def test_classify_bytes_resource_limits():
+    archive = zip_bytes('CT_small.dcm', 'MR_small.dcm')
+    for option, value in [('max_members', 1), ('max_input_mb', 0.01), ('max_member_mb', 0.005),
+                          ('max_header_elements', 20), ('timeout', 1e-9)]:
+        config = {'config': {option: value}, 'inputs': {}}
+        with pytest.raises(dicom_mr_classifier.ResourceLimitError):
+            dicom_mr_classifier.classify_bytes(archive, pytz.utc, config)
+        config['config']['split_series'] = True
+        with pytest.raises(dicom_mr_classifier.ResourceLimitError):
+            dicom_mr_classifier.classify_bytes(archive, pytz.utc, config)
+
+    config = {'config': {'max_members': 2, 'max_input_mb': 1, 'max_header_elements': 1000, 'timeout': 60},
+              'inputs': {}}
+    assert dicom_mr_classifier.classify_bytes(archive, pytz.utc, config) == \
+        dicom_mr_classifier.classify_bytes(archive, pytz.utc)
+
+
+def test_input_limits_span_all_stages(monkeypatch):
+    # Every stage of an input shares one deadline, classification included
+    created = []
+    get_input_limits = dicom_mr_classifier.get_input_limits
+    monkeypatch.setattr(dicom_mr_classifier, 'get_input_limits',
+                        lambda config=None: created.append(get_input_limits(config)) or created[-1])
+    archive = zip_bytes('CT_small.dcm', 'MR_small.dcm')
+    config = {'config': {'slice_geometry': True, 'timeout': 60}, 'inputs': {}}
+    dicom_mr_classifier.classify_bytes(archive, pytz.utc, config)
+    assert len(created) == 1
+
+    dcm = pydicom.dcmread(get_testdata_file('MR_small.dcm'))
+    limits = dicom_mr_classifier.dicom_input.InputLimits(timeout=1e-9)
+    with pytest.raises(dicom_mr_classifier.ResourceLimitError):
+        dicom_mr_classifier.classify_datasets([dcm], pytz.utc, limits=limits)
@@ -0,0 +1,33 @@
+# label_corpus puts the repository on the path
+from label_corpus import compare, generate_labels, load_labels
+import classification_from_label
+
+
+def test_generate_labels_is_deterministic():
+    first = list(generate_labels(1000, seed=3))
+    assert first == list(generate_labels(1000, seed=3))
+    assert first != list(generate_labels(1000, seed=4))
+    assert len(first) == 1000 and all(first)
+
+
+def test_generate_labels_varies_the_vocabulary():
+    labels = load_labels()
+    corpus = list(generate_labels(2000, seed=0, labels=labels))
+    assert len(set(corpus)) > 1900
+    assert any(label.endswith('_ADC') for label in corpus)
+    assert any(label.islower() for label in corpus)
+
+
+def test_matcher_equivalent_on_corpus():
+    result = compare(classification_from_label.infer_classification,
+                     classification_from_label.infer_classification_chain,
+                     generate_labels(2000, seed=0), chunk_size=500)
+    assert result['labels'] == 2000
+    assert result['mismatch_count'] == 0, result['mismatches']
+
+
+def test_compare_reports_mismatches():
+    labels = ['fmri_rest', 'T1_MPRAGE', 'hkjl']
+    result = compare(lambda label: {}, classification_from_label.infer_classification, labels)
+    assert result['mismatch_count'] == 2
+    assert [m[0] for m in result['mismatches']] == ['fmri_rest', 'T1_MPRAGE']
@@ -0,0 +1,91 @@
+import os
+import sys
+import tarfile
+import zipfile
+
+import pydicom
+import pytz
+from pydicom.data import get_testdata_file
+
+test_dir = os.path.dirname(__file__)
+base_dir = os.path.abspath(os.path.join(test_dir, '..'))
+sys.path.append(base_dir)
+import dicom_mr_classifier
+import memory_usage
+
+PIXEL_DATA_SIZE = 48 * 1024 * 1024
+
+# Reading and classifying an input may not take more than this, whatever
+# the size of its pixel data.
+MEMORY_BUDGET = 8 * 1024 * 1024
+
+
+def write_large_inputs(tmpdir):
+    dcm = pydicom.dcmread(get_testdata_file('MR_small.dcm'))
+    # Like real images, and unlike runs of one byte value, these pixels do not
+    # inflate a thousandfold out of the few compressed blocks read at a time
+    block = bytes(bytearray((i * 7919 + i // 251) % 256 for i in range(1 << 16)))
+    dcm.PixelData = block * (PIXEL_DATA_SIZE // len(block))
+    dcm_path = str(tmpdir.join('large.dcm'))
+    dcm.save_as(dcm_path)
+
+    inputs = [dcm_path]
+    for compression, name in [(zipfile.ZIP_STORED, 'stored.zip'), (zipfile.ZIP_DEFLATED, 'deflated.zip')]:
+        zip_path = str(tmpdir.join(name))
+        with zipfile.ZipFile(zip_path, 'w', compression) as zf:
+            zf.write(get_testdata_file('CT_small.dcm'), 'CT_small.dcm')
+            zf.write(dcm_path, 'large.dcm')
+        inputs.append(zip_path)
+
+    tar_path = str(tmpdir.join('large.tar.gz'))
+    with tarfile.open(tar_path, 'w:gz', compresslevel=1) as tf:
+        tf.add(dcm_path, 'large.dcm')
+    inputs.append(tar_path)
+    return inputs
+
+
+def test_peak_memory_does_not_grow_with_pixel_data(tmpdir):
+    dcm_path, stored_path, deflated_path, tar_path = write_large_inputs(tmpdir)
+    for path in [dcm_path, stored_path, deflated_path, tar_path]:
+        tracker = memory_usage.MemoryTracker()
+        with tracker.stage(path):
+            metadata = dicom_mr_classifier.classify_input(path, pytz.utc)
+        assert metadata['acquisition']['files'][0]['modality'] == 'MR'
+        assert tracker.peak() < MEMORY_BUDGET, '%s peaked at %d bytes' % (path, tracker.peak())
+
+    # An input read from a file object is not copied either
+    with open(dcm_path, 'rb') as fileobj:
+        tracker = memory_usage.MemoryTracker()
+        with tracker.stage('fileobj'):
+            dicom_mr_classifier.classify_input(fileobj, pytz.utc)
+        assert tracker.peak() < MEMORY_BUDGET
+
+
+def test_memory_tracker_stages():
+    tracker = memory_usage.MemoryTracker()
+    with tracker.stage('allocate'):
+        data = bytearray(4 * 1024 * 1024)
+    with tracker.stage('idle'):
+        pass
+    del data
+    allocate, idle = tracker.stages
+    assert allocate.name == 'allocate' and allocate.traced_peak >= 4 * 1024 * 1024
+    assert idle.traced_peak < 1024 * 1024
+    assert allocate.rss_before > 0 and allocate.rss_after > 0
+
+    disabled = memory_usage.MemoryTracker(enabled=False)
+    with disabled.stage('allocate'):
+        pass
+    assert disabled.stages == []
+
+
+def test_memory_tracker_nested_stages():
+    tracker = memory_usage.MemoryTracker()
+    with tracker.stage('outer'):
+        data = bytearray(4 * 1024 * 1024)
+        del data
+        with tracker.stage('inner'):
+            pass
+    inner, outer = tracker.stages
+    assert inner.traced_peak < 1024 * 1024
+    assert outer.traced_peak >= 4 * 1024 * 1024
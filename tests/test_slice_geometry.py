@@ -0,0 +1,115 @@
+import io
+import os
+import sys
+import tarfile
+import zipfile
+
+import numpy as np
+import pydicom
+import pytz
+from pydicom.data import get_testdata_file
+
+test_dir = os.path.dirname(__file__)
+base_dir = os.path.abspath(os.path.join(test_dir, '..'))
+sys.path.append(base_dir)
+import dicom_input
+import dicom_mr_classifier
+import slice_geometry
+
+AXIAL = [1, 0, 0, 0, 1, 0]
+CORONAL = [1, 0, 0, 0, 0, -1]
+SAGITTAL = [0, 1, 0, 0, 0, -1]
+
+
+def test_summarize_spacing_and_gaps():
+    # Two volumes of 2000 axial slices 1.5 mm apart, with two slices missing
+    z = np.delete(np.arange(2000) * 1.5, [500, 501])
+    positions = np.zeros((2 * len(z), 3))
+    positions[:, 2] = np.tile(z, 2)
+    orientations = np.tile(AXIAL, (len(positions), 1)).astype(float)
+
+    summary = slice_geometry.summarize(positions, orientations)
+    assert summary['Instances'] == 2 * 1998
+    assert summary['SliceCount'] == 1998
+    assert summary['SliceSpacing'] == 1.5
+    assert summary['SliceSpacingMax'] == 4.5
+    assert summary['Gaps'] == 1
+    assert not summary['UniformSpacing']
+    assert summary['OrientationConsistent']
+    assert not summary['Localizer']
+    assert not summary['Mosaic']
+
+
+def test_summarize_missing_geometry():
+    summary = slice_geometry.summarize(np.full((3, 3), np.nan), np.full((3, 6), np.nan))
+    assert summary == {'Instances': 3, 'Mosaic': False}
+
+
+def localizer_zip():
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for n, orientation in enumerate([AXIAL, CORONAL, SAGITTAL] * 3):
+            dcm = pydicom.dcmread(get_testdata_file('MR_small.dcm'))
+            dcm.SeriesDescription = 'series_7'
+            dcm.ImageOrientationPatient = orientation
+            dcm.ImagePositionPatient = [0, 0, n * 5]
+            dcm.SOPInstanceUID = '%s.%d' % (dcm.SOPInstanceUID, n)
+            member = io.BytesIO()
+            dcm.save_as(member)
+            zf.writestr('%02d.dcm' % n, member.getvalue())
+    return buf.getvalue()
+
+
+def test_classify_localizer_from_geometry():
+    buf = localizer_zip()
+    metadata = dicom_mr_classifier.classify_bytes(buf, pytz.utc)
+    entry = metadata['acquisition']['files'][0]
+    assert entry['classification'] == {'Custom': ['N/A']}
+    assert 'SliceGeometry' not in entry['info']
+
+    config = {'config': {'slice_geometry': True}, 'inputs': {}}
+    metadata = dicom_mr_classifier.classify_bytes(buf, pytz.utc, config)
+    entry = metadata['acquisition']['files'][0]
+    assert entry['classification'] == {'Intent': ['Localizer']}
+    geometry = entry['info']['SliceGeometry']
+    assert geometry['Instances'] == 9
+    assert geometry['Orientations'] == 3
+    assert not geometry['OrientationConsistent']
+    assert geometry['Localizer']
+    assert 'SliceCount' not in geometry
+
+    # The slice geometry takes precedence over the acquisition parameters
+    config['config']['parameter_classification'] = True
+    metadata = dicom_mr_classifier.classify_bytes(buf, pytz.utc, config)
+    assert metadata['acquisition']['files'][0]['classification'] == {'Intent': ['Localizer']}
+
+
+def test_split_series_geometry_in_one_pass(tmpdir, monkeypatch):
+    zip_path = str(tmpdir.join('localizer.zip'))
+    tmpdir.join('localizer.zip').write_binary(localizer_zip())
+    tar_path = str(tmpdir.join('localizer.tar.gz'))
+    with zipfile.ZipFile(zip_path) as zf, tarfile.open(tar_path, 'w:gz') as tf:
+        for name in zf.namelist():
+            info = tarfile.TarInfo(name)
+            data = zf.read(name)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+
+    passes = []
+    members = dicom_input.DicomInput.members
+
+    def counted_members(self, *args, **kwargs):
+        passes.append(self.kind)
+        return members(self, *args, **kwargs)
+
+    monkeypatch.setattr(dicom_input.DicomInput, 'members', counted_members)
+    config = {'config': {'slice_geometry': True, 'split_series': True}, 'inputs': {}}
+    entries = []
+    for path in [zip_path, tar_path]:
+        metadata = dicom_mr_classifier.classify_input(path, pytz.utc, config)
+        [entry] = metadata['acquisition']['files']
+        assert entry['classification'] == {'Intent': ['Localizer']}
+        assert entry['info']['SliceGeometry']['Instances'] == 9
+        entries.append(entry)
+    assert entries[0]['info'] == entries[1]['info']
+    assert passes == [dicom_input.ZIP, dicom_input.TAR]
@@ -0,0 +1,37 @@
+import os
+import sys
+
+from pydicom.multival import MultiValue
+from pydicom.valuerep import IS, DSfloat, PersonName
+
+test_dir = os.path.dirname(__file__)
+base_dir = os.path.abspath(os.path.join(test_dir, '..'))
+sys.path.append(base_dir)
+import value_conversion
+
+
+def test_format_string():
+    assert value_conversion.format_string('T1w\x00 MPR\xe9中') == 'T1w MPR'
+    assert value_conversion.format_string('\t?\x1b') == '\t?'
+    assert value_conversion.format_string('?') is None
+    assert value_conversion.format_string(PersonName('Doe^J\xe9')) == 'Doe^J'
+
+
+def test_assign_type():
+    assert value_conversion.assign_type(IS('5'), 'IS') == 5
+    assert isinstance(value_conversion.assign_type(IS('5'), 'IS'), int)
+    assert value_conversion.assign_type(DSfloat('2'), 'DS') == 2
+    assert isinstance(value_conversion.assign_type(DSfloat('2'), 'DS'), int)
+    assert value_conversion.assign_type(DSfloat('1.50'), 'DS') == 1.5
+    assert value_conversion.assign_type('x\x7fy') == 'xy'
+    assert value_conversion.assign_type(MultiValue(IS, ['1', '2']), 'IS') == [1.0, 2.0]
+    assert value_conversion.assign_type([1, 2.5], 'FD') == [1, 2.5]
+    assert value_conversion.assign_type(MultiValue(str, ['1', '2.5']), 'CS') == [1.0, 2.5]
+    assert value_conversion.assign_type(MultiValue(str, ['A', '', '1']), 'CS') == ['A', '1']
+
+
+def test_conversions_are_memoized():
+    value_conversion.parse_string.cache_clear()
+    for _ in range(3):
+        assert value_conversion.assign_type(DSfloat('0.8125'), 'DS') == 0.8125
+    assert value_conversion.parse_string.cache_info().hits == 2
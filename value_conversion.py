@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+'''
+Convert DICOM and CSA header values to the values of the file info.
+
+Values are converted according to the VR of their element: binary numbers
+(US, UL, SS, SL, FL, FD) are kept as they are, number strings (IS, DS) and
+any other string parsed as an int or a float when they hold one, and
+strings are otherwise reduced to their printable ASCII characters.
+
+The same values repeat across the headers of an input, so the conversions
+of strings are memoized.
+'''
+
+import string
+import functools
+
+import pydicom
+
+# Distinct strings whose conversion is remembered
+CACHE_SIZE = 65536
+
+# VRs whose values pydicom decodes to Python ints and floats
+BINARY_NUMBER_VRS = frozenset(["US", "UL", "SS", "SL", "FL", "FD", "UV", "SV"])
+
+# VRs of numbers encoded as strings, decoded to IS and DSfloat by pydicom
+STRING_NUMBER_VRS = frozenset(["IS", "DS"])
+
+# Translate table removing the ASCII characters that are not printable
+_UNPRINTABLE = dict.fromkeys(c for c in range(128) if chr(c) not in string.printable)
+
+_NUMBER_TYPES = (int, float)
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def sanitize(text):
+    """
+    Remove the characters of text that are not printable ASCII. Returns
+    None if all that is left is "?", the placeholder of unknown values.
+    """
+    if not text.isascii():
+        text = text.encode("ascii", "ignore").decode("ascii")
+    text = text.translate(_UNPRINTABLE)
+    return None if text == "?" else text
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def parse_string(text):
+    """The int or else float text holds, or else text sanitized."""
+    try:
+        return int(text)
+    except ValueError:
+        try:
+            return float(text)
+        except ValueError:
+            return sanitize(text)
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _float_or_none(text):
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def format_string(value):
+    """The string of value sanitized."""
+    return sanitize(str(value))
+
+
+def assign_type(value, VR=None):
+    """
+    Convert a header value: numbers stay numbers, strings become the int or
+    float they hold, or else are sanitized. Multiple values become a list
+    of floats if they are all numbers, or else of their non-empty strings
+    sanitized.
+    """
+    value_type = type(value)
+    if value_type is int or value_type is float:
+        return value
+    if value_type is list or value_type is pydicom.multival.MultiValue:
+        return _assign_types(value, VR)
+    if isinstance(value, pydicom.valuerep.PersonName):
+        return format_string(value)
+    return parse_string(str(value))
+
+
+def _assign_types(values, VR):
+    if VR in BINARY_NUMBER_VRS and all(type(v) in _NUMBER_TYPES for v in values):
+        return [v if type(v) is int else float(v) for v in values]
+    if VR in STRING_NUMBER_VRS and all(isinstance(v, _NUMBER_TYPES) for v in values):
+        # IS values are ints, but only values of type int itself stay ints
+        return [v if type(v) is int else float(v) for v in values]
+    if all(type(v) is str for v in values):
+        numbers = [_float_or_none(v) for v in values]
+        if None not in numbers:
+            return numbers
+        return [sanitize(v) for v in values if len(v) > 0]
+
+    try:
+        return [int(v) if type(v) == int else float(v) for v in values]
+    except ValueError:
+        return [format_string(v) for v in values if len(v) > 0]